@@ -1,14 +1,65 @@
 #!/usr/bin/env python3
 # realtime_chat_single_file.py - Modern attractive chat with multiple media types (no extra packages)
 import http.server, socketserver, threading, time, json, os, sys, urllib.parse, socket, subprocess, re, mimetypes, base64
-from collections import deque
+import asyncio, io, argparse, random, math, select, http.client, traceback, tempfile, email.utils, hashlib, gzip, struct, mmap, signal, zlib, html, bisect
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, deque
+from array import array
+try: import brotli   # optional: adds a br variant of the page assets
+except ImportError: brotli = None
 
 HOST = "0.0.0.0"
 PORT = 8080
-MAX_MESSAGES = 500
+MAX_MESSAGES = 500          # in-memory window per room; older history comes from the journal
+HISTORY_PAGE = 50           # default /history page size
+HISTORY_MAX_PAGE = 500
 UPLOAD_DIR = "uploads"
+UPLOAD_INDEX = "upload_index.jsonl"   # which message uses which upload; kept outside UPLOAD_DIR, which is served
 EMOJI_DIR = "emojis"
 STICKER_DIR = "stickers"
+ENGINE = "threaded"          # "threaded" (one thread per connection) or "async" (see AsyncChatServer)
+ASYNC_POOL_SIZE = 32         # worker threads for non-stream requests in the async engine
+ASYNC_BACKLOG = 4096
+DEFAULT_ROOM = "main"
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+MAX_ROOMS = 1000             # rooms are created on first use, up to this many
+MAX_UPLOAD_BYTES = 1024 * 1024 * 1024   # whole request body; larger uploads get 413
+UPLOAD_CHUNK = 64 * 1024                # read size for streaming uploads to disk
+UPLOAD_CONCURRENCY = 8                  # uploads being received at once; more get 503 with Retry-After
+MEDIA_WORKERS = 2                       # threads that sniff uploads and publish their messages
+MEDIA_SNIFF_BYTES = 64 * 1024           # header bytes read to sniff an upload
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+JOURNAL_DIR = "journal"
+JOURNAL_SEGMENT_BYTES = 16 * 1024 * 1024   # rotate to a new segment past this size
+JOURNAL_MAX_SEGMENTS = 64                  # oldest segments beyond this are deleted
+JOURNAL_FLUSH_MS = 50                      # group-commit window: one write+fsync per batch
+SSE_COALESCE_MS = 0          # extra wait before each /stream write so bursts share one write (0 = off)
+SSE_WRITE_TIMEOUT = 10       # seconds a /stream or /ws write may block before the subscriber is dropped
+SUBSCRIBER_QUEUE = 256       # messages a subscriber may fall behind (at most MAX_MESSAGES for the threaded engine)
+SUBSCRIBER_MAX_LAG = 30      # seconds; with --slow-consumer disconnect, an older pending message drops the subscriber
+SLOW_CONSUMER = "drop"       # past SUBSCRIBER_QUEUE: "drop" the oldest and send a resync event, or "disconnect"
+HEARTBEAT_INTERVAL = 15      # seconds of silence before a /stream or /ws gets a ping; one that can't take it is reaped
+HEARTBEAT_TICK = 1           # resolution of the heartbeat timer wheel, seconds
+HEARTBEAT_ACK_TIMEOUT = 30   # seconds sent data may go unacknowledged before the kernel drops a stream (Linux)
+SSE_RETRY_MS = (1000, 10000) # each /stream is told to reconnect after a random delay in this range
+SIGNAL_BACKLOG = 64          # recent signals (presence, typing) a room keeps for its threaded streams
+PRESENCE_GRACE = 15          # seconds a user stays online after their last stream closes (reloads, reconnects)
+CALL_TTL = 4 * 3600          # seconds before a call nobody ended is dropped
+TYPING_INTERVAL = 1          # seconds; a room's typing indicator is sent at most this often
+TYPING_TTL = 5               # seconds someone shows as typing after their last typing event
+TYPING_SHOWN = 5             # names in the indicator; the rest are a count
+BUS_TIMEOUT = 5              # seconds to wait for a room snapshot from the bus hub
+KEEPALIVE_TIMEOUT = 75       # idle seconds before a persistent HTTP/1.1 connection is closed
+ASYNC_BODY_BUFFER = 1024 * 1024         # async engine: larger bodies (uploads) are streamed from the socket
+SEND_BATCH_MAX = 100                    # messages per /send-batch request
+RATE_LIMITS = {"send": (5, 20), "batch": (20, 100), "call": (0.2, 3), "upload": (1, 10), "typing": (1, 5)}   # route class -> (requests/s, burst) per username; batch counts messages
+RATE_IP_SHARE = 4                       # an address gets this many times a username's budget (NAT, the tunnel)
+SEARCH_PAGE = 20                        # default /search page size
+SEARCH_MAX_PAGE = 100
+SEARCH_BUILD_WAIT = 10                  # seconds /search waits for a room's index to be built
+ACCESS_LOG_BUFFER = 64 * 1024           # --access-log lines are buffered and flushed every second
+WS_MAX_MESSAGE = 64 * 1024   # largest inbound WebSocket message
+WS_DEFLATE = True            # accept permessage-deflate when the browser offers it
 
 for dir in [UPLOAD_DIR, EMOJI_DIR, STICKER_DIR]:
     os.makedirs(dir, exist_ok=True)
@@ -113,8 +164,10 @@ def init_default_assets():
     
     for name, emoji in common_emojis.items():
         try:
-            with open(os.path.join(EMOJI_DIR, f"{name}.txt"), "w", encoding="utf-8") as f:
+            with open(os.path.join(EMOJI_DIR, f"{name}.txt"), "x", encoding="utf-8") as f:
                 f.write(emoji)
+        except FileExistsError:
+            continue   # keep whatever is on disk; only missing defaults are created
         except Exception as e:
             print(f"Warning: Could not save emoji {name}: {e}")
 
@@ -155,17 +208,1068 @@ def init_default_assets():
     
     for name, text in sticker_data.items():
         try:
-            with open(os.path.join(STICKER_DIR, f"{name}.txt"), "w", encoding="utf-8") as f:
+            with open(os.path.join(STICKER_DIR, f"{name}.txt"), "x", encoding="utf-8") as f:
                 f.write(text)
+        except FileExistsError:
+            continue   # keep whatever is on disk; only missing defaults are created
         except Exception as e:
             print(f"Warning: Could not save sticker {name}: {e}")
 
-messages = deque(maxlen=MAX_MESSAGES)
-msg_cond = threading.Condition()
-active_calls = {}
+class Metrics:
+    # Counters and histograms for GET /metrics (Prometheus text format). An update
+    # is a bisect outside the lock and a couple of dict/list ops under it. Series
+    # are keyed by (name, labels), labels being a tuple of (key, value) pairs.
+    LATENCY = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+    LOCK = (1e-6, 1e-5, 1e-4, 1e-3, .01, .1, 1)
+    SIZE = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+    HELP = {"http_requests_total": "Requests by route, method and status",
+            "http_request_duration_seconds": "Time to handle a request (not /stream or /ws)",
+            "http_response_bytes_total": "Response body bytes, excluding /stream and /ws",
+            "chat_messages_appended_total": "Messages appended to a room",
+            "chat_cond_wait_seconds": "Time a publish waited for its room's condition lock",
+            "chat_cond_hold_seconds": "Time a publish held its room's condition lock",
+            "chat_fanout_lag_seconds": "Append to stream write, for the oldest message of each write after a stream's backlog",
+            "chat_stream_bytes_total": "Bytes written to /stream and /ws subscribers",
+            "chat_upload_size_bytes": "Size of uploaded files",
+            "chat_slow_consumer_total": "Subscribers that fell behind, by what was done (drop, disconnect, timeout)",
+            "chat_missed_messages_total": "Messages dropped for slow subscribers",
+            "chat_heartbeats_total": "Pings written to idle /stream and /ws subscribers",
+            "chat_streams_reaped_total": "Subscribers closed because a ping could not be written",
+            "chat_rate_limited_total": "Requests refused by the rate limiter, by route class and whose budget ran out",
+            "chat_streams": "Open /stream and /ws subscribers",
+            "chat_rooms": "Rooms in memory",
+            "chat_users_online": "Users with an open stream, summed over rooms",
+            "chat_signals_total": "Ephemeral events sent to a room's streams, by kind"}
+
+    def __init__(self): self.lock = threading.Lock(); self.counters = {}; self.hists = {}
+
+    def inc(self, name, labels=(), n=1):
+        key = (name, labels)
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, labels=(), buckets=LATENCY):
+        i = bisect.bisect_left(buckets, value); key = (name, labels)
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None: h = self.hists[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            h[1][i] += 1; h[2] += value
+
+    def request(self, method, path, status, seconds):
+        route = route_label(path)
+        self.inc("http_requests_total", (("method", method), ("route", route), ("status", str(status or 0))))
+        if route not in ("/stream", "/ws"): self.observe("http_request_duration_seconds", seconds, (("route", route),))
+
+    def published(self, n, wait, hold):
+        self.inc("chat_messages_appended_total", n=n)
+        self.observe("chat_cond_wait_seconds", wait, buckets=self.LOCK); self.observe("chat_cond_hold_seconds", hold, buckets=self.LOCK)
+
+    def render(self, gauges):
+        with self.lock:
+            counters = sorted(self.counters.items()); hists = sorted((k, (b, list(c), t)) for k, (b, c, t) in self.hists.items())
+        fmt = lambda labels: "{%s}" % ",".join('%s="%s"' % kv for kv in labels) if labels else ""
+        out = []; typed = set()
+        def head(name, kind):
+            if name not in typed: typed.add(name); out.extend((f"# HELP {name} {self.HELP.get(name, name)}", f"# TYPE {name} {kind}"))
+        for (name, labels), v in counters: head(name, "counter"); out.append(f"{name}{fmt(labels)} {v}")
+        for (name, labels), (buckets, counts, total) in hists:
+            head(name, "histogram"); n = 0
+            for le, c in zip(buckets + ("+Inf",), counts):
+                n += c; out.append(f"{name}_bucket{fmt(labels + (('le', str(le)),))} {n}")
+            out += [f"{name}_sum{fmt(labels)} {total}", f"{name}_count{fmt(labels)} {n}"]
+        for (name, labels), v in sorted(gauges.items()): head(name, "gauge"); out.append(f"{name}{fmt(labels)} {v}")
+        return ("\n".join(out) + "\n").encode()
+
+metrics = Metrics()
+
+# A message is serialized exactly once, when it is appended; every subscriber
+# and /history share the resulting immutable bytes. at is when it arrived here
+# (time.monotonic()), for the fan-out lag metric.
+Entry = namedtuple("Entry", "seq msg json frame cache at")   # cache: other encodings, built on first use
+
+def make_entry(msg):
+    data = json.dumps(msg).encode()
+    return Entry(msg["seq"], msg, data, b"id: %d\ndata: %s\n\n"%(msg["seq"], data), {}, time.monotonic())
+
+# Signals are ephemeral room events (presence changes, who is typing): pushed to the room's open
+# streams as "event: <kind>" (SSE) or a {"type": kind, ...} frame (/ws), never
+# stored or journaled. n counts a room's signals, so a stream can tell it missed some.
+Signal = namedtuple("Signal", "n kind data frame")
+
+def make_signal(n, kind, data):
+    data = json.dumps(dict(data, type=kind)).encode()
+    return Signal(n, kind, data, b"event: %s\ndata: %s\n\n" % (kind.encode(), data))
+
+class MessageLog:
+    # Fixed-size ring of messages keyed by a monotonic sequence number.
+    # Callers hold the room's cond; since() only touches the entries it returns.
+    def __init__(self, size):
+        self.size = size; self.buf = [None]*size; self.seq = 0; self._history = None
+    def append(self, msg):
+        self.seq += 1; msg["seq"] = self.seq
+        e = self.buf[self.seq % self.size] = make_entry(msg)
+        self._history = None
+        return e
+    def put(self, msg):
+        # Store a message that already carries its seq (replayed, or sequenced by the bus hub).
+        self.seq = msg["seq"]; e = self.buf[self.seq % self.size] = make_entry(msg)
+        self._history = None
+        return e
+    def load(self, msgs):
+        for m in msgs[-self.size:]: self.put(m)
+    def first(self): return max(1, self.seq - self.size + 1)
+    def since(self, seq): return self.between(seq+1, self.seq)
+    def between(self, lo, hi):
+        r = range(max(lo, self.first()), min(hi, self.seq)+1)
+        return [e for s in r if (e := self.buf[s % self.size]) is not None and e.seq == s]
+    def latest_json(self):
+        # The default /history page, cached until the next append; rebuilding only joins pre-encoded messages.
+        if self._history is None: self._history = b"[" + b", ".join(e.json for e in self.since(self.seq-HISTORY_PAGE)) + b"]"
+        return self._history
+    def __len__(self): return min(self.seq, self.size)
+
+class Journal:
+    # Segmented append-only message journal, one per room. append() only queues
+    # the already encoded JSON; a single writer thread shared by all rooms writes
+    # each batch and fsyncs once per batch, so /send never waits on the disk. Segment <first seq>.log holds one JSON
+    # line per message and <first seq>.idx holds fixed-width (seq, offset)
+    # records, so a restart reads the tail via the mmap'd index instead of
+    # parsing the whole journal.
+    REC = struct.Struct("<QQ")
+    dirty = set(); dirty_cond = threading.Condition(); flusher = None   # journals with pending entries
+
+    def __init__(self, directory, readonly=False):
+        os.makedirs(directory, exist_ok=True)
+        self.dir = directory; self.cond = threading.Condition(); self.wlock = threading.Lock(); self.readonly = readonly
+        self.pending = []; self.closed = False; self.log = self.idx = None; self.flushed_seq = 0
+        self.segments = self.scan()
+        if readonly: self.flushed_seq = 1 << 63; return   # another process writes; read() takes what is on disk
+        with Journal.dirty_cond:
+            if Journal.flusher is None:
+                Journal.flusher = threading.Thread(target=Journal.writer, name="journal", daemon=True); Journal.flusher.start()
+
+    def path(self, first, ext): return os.path.join(self.dir, f"{first:020d}.{ext}")
+    def scan(self): return sorted(int(f[:-4]) for f in os.listdir(self.dir) if f.endswith(".log"))
+
+    def append(self, *entries):
+        with self.cond: self.pending.extend(entries); first = len(self.pending) == len(entries)
+        if first:
+            with Journal.dirty_cond: Journal.dirty.add(self); Journal.dirty_cond.notify()
+
+    @staticmethod
+    def writer():
+        while True:
+            with Journal.dirty_cond:
+                while not Journal.dirty: Journal.dirty_cond.wait()
+            time.sleep(JOURNAL_FLUSH_MS / 1000)   # let the batches grow
+            with Journal.dirty_cond: dirty, Journal.dirty = Journal.dirty, set()
+            for j in dirty: j.flush()
+
+    def flush(self):
+        with self.wlock:
+            with self.cond: batch, self.pending = self.pending, []
+            if not batch or self.closed: return
+            try: self.write_batch(batch)
+            except OSError as ex: print(f"Warning: journal write failed: {ex}")
+
+    def write_batch(self, batch):
+        for e in batch:
+            if self.log is None or self.log.tell() >= JOURNAL_SEGMENT_BYTES: self.rotate(e.seq)
+            self.idx.write(self.REC.pack(e.seq, self.log.tell())); self.log.write(e.json + b"\n")
+        self.log.flush(); self.idx.flush()
+        os.fsync(self.log.fileno()); os.fsync(self.idx.fileno())
+        with self.cond: self.flushed_seq = batch[-1].seq
+
+    def rotate(self, first):
+        # A full segment is followed by a fresh one. The first write of a process continues
+        # the newest segment instead (see reopen), so restarts don't use up JOURNAL_MAX_SEGMENTS.
+        # A leftover segment with the same first seq only holds records replay rejected.
+        if self.log: self.log.close(); self.idx.close()
+        elif self.segments and self.reopen(first): return
+        self.log = open(self.path(first, "log"), "wb"); self.idx = open(self.path(first, "idx"), "wb")
+        with self.cond:
+            if first not in self.segments: self.segments.append(first)
+            dropped = self.segments[:-JOURNAL_MAX_SEGMENTS]; del self.segments[:-JOURNAL_MAX_SEGMENTS]
+        for old in dropped:
+            for ext in ("log", "idx"):
+                try: os.remove(self.path(old, ext))
+                except OSError: pass
+
+    def reopen(self, seq):
+        # Opens the newest segment for appending if seq follows its last whole record and it
+        # has room. A torn record left by a crash is cut off first: an index record whose line
+        # is missing or incomplete, and any bytes after the last indexed line.
+        first = self.segments[-1]
+        try: log = open(self.path(first, "log"), "r+b"); idx = open(self.path(first, "idx"), "r+b")
+        except OSError: return False
+        count = os.fstat(idx.fileno()).st_size // self.REC.size; end = 0
+        try:
+            while count:
+                idx.seek((count-1) * self.REC.size); _, offset = self.REC.unpack(idx.read(self.REC.size))
+                log.seek(offset); line = log.readline()
+                try:
+                    if line.endswith(b"\n") and json.loads(line)["seq"] == first + count - 1: end = offset + len(line); break
+                except (ValueError, KeyError, TypeError): pass
+                count -= 1
+            if first + count != seq or end >= JOURNAL_SEGMENT_BYTES: raise OSError("segment can't be continued")
+            log.truncate(end); idx.truncate(count * self.REC.size); log.seek(end); idx.seek(count * self.REC.size)
+        except OSError: log.close(); idx.close(); return False
+        self.log, self.idx = log, idx
+        return True
+
+    def tail(self, n):
+        # Last n messages, newest last. Only those n lines are read and parsed.
+        out = []
+        for first in reversed(self.segments):
+            try:
+                with open(self.path(first, "idx"), "rb") as f:
+                    count = os.fstat(f.fileno()).st_size // self.REC.size
+                    if not count: continue
+                    take = min(n - len(out), count)
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        _, offset = self.REC.unpack_from(mm, (count - take) * self.REC.size)
+                with open(self.path(first, "log"), "rb") as f:
+                    f.seek(offset); lines = f.read().split(b"\n")[:take]
+            except (OSError, ValueError): continue
+            msgs = []
+            for line in lines:
+                try: msgs.append(json.loads(line))
+                except ValueError: break   # torn write at the end of a segment
+            out = msgs + out
+            if len(out) >= n: break
+        if out:
+            with self.cond: self.flushed_seq = max(self.flushed_seq, out[-1]["seq"])
+        return out
+
+    def read(self, lo, hi):
+        # JSON of messages lo..hi (inclusive) that are safely on disk, oldest first.
+        # Seqs are contiguous within a segment, so record k of <first>.idx is seq first+k.
+        if self.readonly: self.segments = self.scan()   # the writer rotates behind our back
+        with self.cond: segs = list(self.segments); hi = min(hi, self.flushed_seq)
+        out = []
+        for i, first in enumerate(segs):
+            last = segs[i+1]-1 if i+1 < len(segs) else hi
+            a, b = max(lo, first), min(hi, last)
+            if a > b: continue
+            try:
+                with open(self.path(first, "idx"), "rb") as f:
+                    f.seek((a-first) * self.REC.size); recs = f.read((b-a+2) * self.REC.size)
+                n = len(recs) // self.REC.size
+                if not n or self.REC.unpack_from(recs)[0] != a: continue
+                offsets = [self.REC.unpack_from(recs, k*self.REC.size)[1] for k in range(n)]
+                with open(self.path(first, "log"), "rb") as f:
+                    f.seek(offsets[0])
+                    data = f.read(offsets[b-a+1]-offsets[0]) if n > b-a+1 else f.read()
+            except OSError: continue
+            out += data.split(b"\n")[:min(n, b-a+1)]
+        return out
+
+    def replay(self):
+        # Every message on disk, oldest first; for rebuilding derived state (the search index).
+        if self.readonly: self.segments = self.scan()
+        with self.cond: segs = list(self.segments); hi = self.flushed_seq
+        for first in segs:
+            try:
+                with open(self.path(first, "log"), "rb") as f: data = f.read()
+            except OSError: continue
+            for line in data.split(b"\n"):
+                try: msg = json.loads(line)
+                except ValueError: break   # torn write at the end of a segment
+                if msg["seq"] > hi: return
+                yield msg
+
+    def close(self):
+        self.flush()
+        with self.wlock:
+            self.closed = True
+            if self.log: self.log.close(); self.idx.close()
+
+class Room:
+    # One channel with its own ring, journal and condition, so a message wakes
+    # only the subscribers of the room it was sent to.
+    def __init__(self, name, journal_dir=None):
+        self.name = name; self.messages = MessageLog(MAX_MESSAGES); self.cond = threading.Condition(); self.journal = None
+        self.signals = deque(maxlen=SIGNAL_BACKLOG); self.signal_n = 0
+        self.online = {}; self.calls = {}   # user -> open streams (1 on a bus follower), call id -> call; kept by presence
+        self.typing = {}                     # user -> when they stop showing as typing; kept by typists
+        if journal_dir:
+            # The default room keeps the journal root, so single-room journals replay unchanged.
+            self.journal = Journal(journal_dir if name == DEFAULT_ROOM else os.path.join(journal_dir, name), readonly=not bus.sequencer)
+        bus.join(self)
+
+    def publish(self, msg): return bus.publish(self, msg)
+    def publish_many(self, msgs): return bus.publish_many(self, msgs)
+
+    def deliver(self, msg):
+        # A message the bus hub already sequenced; wakes local subscribers like a local publish.
+        t0 = time.perf_counter()
+        with self.cond:
+            t1 = time.perf_counter()
+            e = self.messages.put(msg); self.cond.notify_all()
+            for fn in msg_listeners: fn(self, e)
+        metrics.published(1, t1 - t0, time.perf_counter() - t1)
+        return e
+
+    def signal(self, kind, data):
+        with self.cond:
+            self.signal_n += 1; sig = make_signal(self.signal_n, kind, data)
+            self.signals.append(sig); self.cond.notify_all()
+            for fn in signal_listeners: fn(self, sig)
+        metrics.inc("chat_signals_total", (("kind", kind),))
+        return sig
+
+    def signals_since(self, n): return [s for s in self.signals if s.n > n]   # callers hold cond
+
+    def reset(self):
+        # The bus hub has fewer messages than this room: it restarted without its journal and
+        # numbers from 1 again, so the ring starts over. Open streams are closed; their clients
+        # reconnect with a cursor ahead of the log, which gets them the hub's history.
+        with self.cond: self.messages = MessageLog(MAX_MESSAGES); self.cond.notify_all()
+        search.drop(self)
+        for st in list(streams):
+            if st.room == self.name: st.close()
+
+rooms = {}
+rooms_lock = threading.Lock()
+msg_listeners = []   # called as fn(room, entry) under room.cond with each new message (async engine fan-out)
+signal_listeners = []   # likewise, fn(room, signal) with each signal
+journal_root = None  # journal directory when persistence is enabled (see run()); rooms get a subdirectory
+bus = None           # LocalBus, or NetBus when this process follows a hub (see run())
+
+def get_room(name=None):
+    # Rooms are created on first use. None for a bad name or once MAX_ROOMS exist.
+    name = name or DEFAULT_ROOM
+    if not ROOM_NAME.fullmatch(name): return None
+    with rooms_lock:
+        room = rooms.get(name)
+        if room is None and len(rooms) < MAX_ROOMS: room = rooms[name] = Room(name, journal_root)
+    if room: bus.wait(room)   # outside the lock: other rooms stay usable while this one loads
+    return room
 
 def now_ms(): return int(time.time() * 1000)
 
+class BusUnavailable(Exception): pass
+
+class LocalBus:
+    # The message bus of a single process: messages are sequenced, journaled and
+    # handed to the room's subscribers right here.
+    sequencer = True
+    def join(self, room):
+        if room.journal: room.messages.load(room.journal.tail(MAX_MESSAGES))
+    def wait(self, room): pass
+    def publish(self, room, msg): return self.publish_many(room, [msg])[0]
+    def publish_many(self, room, msgs):
+        t0 = time.perf_counter()
+        with room.cond:
+            t1 = time.perf_counter()
+            es = [room.messages.append(m) for m in msgs]; room.cond.notify_all()
+            if room.journal: room.journal.append(*es)
+            for e in es:
+                for fn in msg_listeners: fn(room, e)
+        metrics.published(len(es), t1 - t0, time.perf_counter() - t1)
+        return es
+
+def bus_address(spec):
+    # "host:port" for TCP, "unix:/path" for a Unix domain socket.
+    if spec.startswith("unix:"): return socket.AF_UNIX, spec[5:]
+    host, _, port = spec.rpartition(":")
+    return socket.AF_INET, (host or "0.0.0.0", int(port))
+
+class _BusConn:
+    # One follower as seen by the hub. Lines are queued and written by a thread
+    # of its own, so a slow follower never blocks publish() under room.cond.
+    def __init__(self, sock):
+        self.sock = sock; self.rfile = sock.makefile("rb"); self.cond = threading.Condition(); self.out = []; self.closed = False
+        threading.Thread(target=self.writer, name="bus-out", daemon=True).start()
+    def send(self, line):
+        with self.cond:
+            self.out.append(line)
+            if len(self.out) == 1: self.cond.notify()
+    def writer(self):
+        while True:
+            with self.cond:
+                while not self.out and not self.closed: self.cond.wait()
+                if self.closed: return
+                batch, self.out = self.out, []
+            try: self.sock.sendall(b"".join(batch))
+            except OSError: return
+    def close(self):
+        with self.cond: self.closed = True; self.cond.notify()
+        self.rfile.close(); self.sock.close()
+
+class BusHub:
+    # Serves this process's rooms to followers (NetBus): other nodes over TCP, or
+    # the --workers processes over a Unix socket. Followers send their messages
+    # here to be sequenced and get every message of the rooms they joined back,
+    # in seq order. Their streams and calls are kept here too (see Presence), and
+    # the rooms' signals go back to them. Newline-delimited JSON:
+    #   follower -> hub  {"op": "pub", "room", "msg"}  {"op": "pubs", "room", "msgs"}  {"op": "join", "room", "after"}
+    #                    {"op": "present", "room", "user", "n"}  {"op": "call", "room", "call"}  {"op": "call-end", "room", "callId"}
+    #                    {"op": "typing", "room", "user"}
+    #   hub -> follower  {"op": "snapshot", "room", "seq", "msgs", "presence"}  {"op": "msg", "room", "msg"}  {"op": "signal", "room", "signal"}
+    # A hub that itself follows another hub relays: publishes go upstream and
+    # delivered messages come back down.
+    def __init__(self):
+        self.members = {}   # room name -> set of _BusConn, changed under room.cond
+        self.socks = []; msg_listeners.append(self.on_message); signal_listeners.append(self.on_signal)
+
+    def listen(self, spec):
+        family, addr = bus_address(spec)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr): os.remove(addr)
+            sock = socket.socket(socket.AF_UNIX); sock.bind(addr); sock.listen()
+        else: sock = socket.create_server(addr)
+        self.socks.append((sock, addr))
+        threading.Thread(target=self.accept, args=(sock,), name="bus-hub", daemon=True).start()
+
+    def accept(self, sock):
+        while True:
+            try: conn, _ = sock.accept()
+            except OSError: return
+            if conn.family != socket.AF_UNIX: conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(_BusConn(conn),), name="bus-in", daemon=True).start()
+
+    def serve(self, c):
+        joined = []; present = {}   # (room, user) -> streams the follower has open
+        try:
+            for line in c.rfile:
+                m = json.loads(line); room = get_room(m.get("room"))
+                if room is None: continue
+                try:
+                    if m["op"] in ("pub", "pubs"): room.publish_many(m["msgs"] if m["op"] == "pubs" else [m["msg"]])
+                    elif m["op"] == "join":
+                        # Snapshot and membership change under the same locks, so the follower
+                        # gets every later message and signal exactly once, after the snapshot.
+                        # seq is our head, so a follower can tell we lost messages it has.
+                        with presence.lock, room.cond:
+                            msgs = room.messages.since(int(m.get("after") or 0))
+                            c.send(b'{"op": "snapshot", "room": "%s", "seq": %d, "msgs": [%s], "presence": %s}\n' % (
+                                room.name.encode(), room.messages.seq, b", ".join(e.json for e in msgs), json.dumps(presence.state(room)).encode()))
+                            self.members.setdefault(room.name, set()).add(c); joined.append(room)
+                    elif m["op"] == "present":
+                        n = int(m["n"]); key = (room, m["user"]); present[key] = present.get(key, 0) + n
+                        for _ in range(abs(n)): (presence.join if n > 0 else presence.leave)(room, m["user"])
+                    elif m["op"] == "call": presence.start_call(room, m["call"])
+                    elif m["op"] == "call-end": presence.end_call(room, m["callId"])
+                    elif m["op"] == "typing": typists.typing(room, m["user"])
+                except BusUnavailable: pass   # a relay whose upstream is down
+        except (OSError, ValueError, KeyError, TypeError): pass
+        for room in joined:
+            with room.cond: self.members[room.name].discard(c)
+        for (room, user), n in present.items():   # a follower that went away takes its streams along
+            for _ in range(n): presence.leave(room, user)
+        c.close()
+
+    def on_message(self, room, e):
+        # Runs under room.cond, in seq order.
+        for c in self.members.get(room.name, ()): c.send(b'{"op": "msg", "room": "%s", "msg": %s}\n' % (room.name.encode(), e.json))
+
+    def on_signal(self, room, sig):
+        # Likewise for signals; a follower numbers them itself.
+        for c in self.members.get(room.name, ()): c.send(b'{"op": "signal", "room": "%s", "signal": %s}\n' % (room.name.encode(), sig.data))
+
+    def close(self):
+        for sock, addr in self.socks:
+            sock.close()
+            if isinstance(addr, str):
+                try: os.remove(addr)
+                except OSError: pass
+
+class NetBus:
+    # Follows a BusHub. Publishing only forwards the message; it comes back with
+    # the hub's seq and is delivered to this process's subscribers, so every node
+    # shows one order. A seq that skips ahead of the room (a gap) or a reconnect
+    # makes us re-join the room after our last seq, and the hub resends the rest.
+    # A hub whose head is behind ours lost its history; the room starts over from it.
+    # Presence is the hub's too: we report our streams and get its signals.
+    sequencer = False
+
+    def __init__(self, spec, reconnect=True):
+        self.family, self.addr = bus_address(spec); self.reconnect = reconnect
+        self.sock = None; self.wlock = threading.Lock(); self.rooms = {}; self.ready = {}; self.resyncing = set()
+        self.users = {}; self.ulock = threading.Lock()   # (room name, user) -> our open streams, reported again on reconnect
+        threading.Thread(target=self.run, name="bus", daemon=True).start()
+
+    def send(self, obj):
+        line = json.dumps(obj).encode() + b"\n"
+        with self.wlock:
+            if self.sock is None: raise BusUnavailable("message bus hub is not connected")
+            try: self.sock.sendall(line)
+            except OSError as ex: raise BusUnavailable(str(ex))
+
+    def join(self, room):
+        # Called while get_room() holds rooms_lock, so it only asks for the snapshot; wait() waits for it.
+        self.ready[room.name] = (threading.Event(), time.monotonic() + BUS_TIMEOUT); self.rooms[room.name] = room
+        self.resync(room)
+
+    def wait(self, room):
+        # Until the room's first snapshot is in, or BUS_TIMEOUT after it was asked for.
+        ready, deadline = self.ready[room.name]
+        if not ready.is_set(): ready.wait(deadline - time.monotonic())
+
+    def publish(self, room, msg): self.send({"op": "pub", "room": room.name, "msg": msg})
+    def publish_many(self, room, msgs): self.send({"op": "pubs", "room": room.name, "msgs": msgs})
+
+    def present(self, room, user, n):
+        # One of our streams for user opened (n=1) or closed (-1). ulock keeps the reports
+        # in order; while the hub is away only the count changes.
+        with self.ulock:
+            key = (room.name, user); self.users[key] = self.users.get(key, 0) + n
+            if not self.users[key]: del self.users[key]
+            try: self.send({"op": "present", "room": room.name, "user": user, "n": n})
+            except BusUnavailable: pass
+
+    def resync(self, room):
+        self.resyncing.add(room.name)
+        try: self.send({"op": "join", "room": room.name, "after": room.messages.seq})
+        except BusUnavailable: pass   # run() re-joins every room once connected
+
+    def run(self):
+        while True:
+            try:
+                sock = socket.socket(self.family); sock.connect(self.addr)
+                if self.family != socket.AF_UNIX: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                sock = None
+            if sock:
+                with self.wlock: self.sock = sock
+                for room in list(self.rooms.values()): self.resync(room)
+                with self.ulock:
+                    for (name, user), n in self.users.items():
+                        try: self.send({"op": "present", "room": name, "user": user, "n": n})
+                        except BusUnavailable: break
+                self.read(sock)
+                with self.wlock: self.sock = None
+                sock.close()
+            if not self.reconnect: break
+            time.sleep(1)
+        print("Message bus connection lost, stopping worker")
+        os._exit(1)   # a --workers worker has nothing of its own to flush
+
+    def read(self, sock):
+        try:
+            for line in sock.makefile("rb"):
+                m = json.loads(line); room = self.rooms.get(m["room"])
+                if room is None: continue
+                if m["op"] == "msg": self.apply(room, m["msg"]); continue
+                if m["op"] == "signal": self.signal(room, m["signal"]); continue
+                if m["seq"] < room.messages.seq:
+                    print(f"Message bus hub is at {m['seq']} in room {room.name}, behind our {room.messages.seq}; starting the room over")
+                    room.reset(); self.resync(room); continue
+                self.resyncing.discard(room.name)
+                for msg in m["msgs"]: self.apply(room, msg, snapshot=True)
+                presence.mirror(room, m["presence"])
+                self.ready[room.name][0].set()
+        except (OSError, ValueError, KeyError): pass
+
+    def signal(self, room, data):
+        kind = data.pop("type")
+        if kind == "presence": presence.mirror(room, data)
+        else: room.signal(kind, data)
+
+    def apply(self, room, msg, snapshot=False):
+        # Only this thread delivers, so the room's seq can be read without its lock.
+        head = room.messages.seq
+        if msg["seq"] <= head: return   # already have it (resent by a resync)
+        if msg["seq"] > head + 1 and not snapshot:
+            if room.name not in self.resyncing:
+                print(f"Message bus gap in room {room.name}: have {head}, got {msg['seq']}; resyncing")
+                self.resync(room)
+            return
+        room.deliver(msg)
+
+bus = LocalBus()
+
+def shed(entries, last, policy):
+    # Slow-consumer policy for what a subscriber is about to be sent, given the last seq it got.
+    # (entries, missed): the newest SUBSCRIBER_QUEUE and how many before them it will never see;
+    # None when policy is "disconnect" and it is too far behind. A gap before entries[0] counts
+    # as lag too: the threaded engine's ring and the async engine's queue drop the oldest first.
+    lag = entries[-1].seq - last
+    if policy == "disconnect" and (lag > SUBSCRIBER_QUEUE or time.monotonic() - entries[0].at > SUBSCRIBER_MAX_LAG):
+        metrics.inc("chat_slow_consumer_total", (("action", "disconnect"),)); return None
+    entries = entries[-SUBSCRIBER_QUEUE:]; missed = entries[0].seq - last - 1
+    if missed > 0: metrics.inc("chat_slow_consumer_total", (("action", "drop"),)); metrics.inc("chat_missed_messages_total", n=missed)
+    return entries, missed
+
+def sse_hello():
+    # First bytes of every /stream: a comment, and a reconnect delay picked at random so
+    # the tabs dropped by a restart don't all come back in the same second.
+    return b": hi\nretry: %d\n\n" % random.randint(*SSE_RETRY_MS)
+
+def socket_ready(sock):
+    # (readable or hung up, writable), right now. Socket timeouts don't apply, so this
+    # never blocks, whichever engine owns the socket.
+    if not hasattr(select, "poll"): r, w, _ = select.select([sock], [sock], [], 0); return bool(r), bool(w)
+    p = select.poll(); p.register(sock, select.POLLIN | select.POLLOUT); ev = p.poll(0)
+    ev = ev[0][1] if ev else 0
+    return bool(ev & (select.POLLIN | select.POLLHUP | select.POLLERR | select.POLLNVAL)), bool(ev & select.POLLOUT)
+
+class SSEStream:
+    # One /stream (or /ws) subscriber: where it is in the room (last seq, last signal)
+    # and what to send it next (start, then next), so the engines only do the I/O.
+    # Pending frames go out as a single write; the counters (messages per write is the
+    # batching ratio) are listed at /streams. Writers hold lock while writing, so
+    # heartbeats never land inside a frame. encode builds an entry's frame (ws).
+    PING = {"sse": b": ping\n\n", "ws": b"\x89\x00"}
+    def __init__(self, room, sock, transport="sse", encode=None):
+        self.room = room.name; self.sock = sock; self.transport = transport; self.encode = encode; self.started = time.time()
+        self.messages = self.writes = self.bytes = self.missed = self.pings = 0
+        self.lock = threading.Lock(); self.wrote = time.monotonic(); self.reaped = False; self.on_reap = None
+        self.last = self.sig = 0; self.live = False
+    def start(self, room, last, backlog):
+        # The first bytes: the room's presence state, then backlog (entries past last).
+        sigs, self.sig = presence.attach(room); self.last = last
+        return self.signals(sigs) + self.next(room, backlog)
+    def next(self, room, items):
+        # Bytes for entries and signals that arrived (any order, already sent ones are
+        # skipped), after the slow-consumer policy; None when it drops the stream. The
+        # first call gets the backlog, which may be a reconnect's worth and isn't lag.
+        sigs, self.sig = catch_up_signals(room, self.sig, [s for s in items if isinstance(s, Signal)])
+        entries = [e for e in items if isinstance(e, Entry) and e.seq > self.last]
+        data = self.signals(sigs)
+        if entries:
+            out = shed(entries, self.last, SLOW_CONSUMER if self.live else "drop")
+            if out is None: return None
+            entries, missed = out
+            data += self.resync(missed) + self.batch(entries); self.last = entries[-1].seq
+        self.live = True
+        return data
+    def waiting(self, room):
+        # Nothing new for this stream; callers hold room.cond.
+        return self.last >= room.messages.seq and self.sig >= room.signal_n
+    def resync(self, missed):
+        # Tells the client it lost messages; it reloads /history. Empty when nothing was lost.
+        if missed <= 0: return b""
+        self.missed += missed
+        if self.transport == "ws": return ws_frame(b'{"type": "resync", "missed": %d}' % missed)
+        return b'event: resync\ndata: {"missed": %d}\n\n' % missed
+    def signals(self, sigs):
+        data = b"".join(ws_frame(s.data) for s in sigs) if self.transport == "ws" else b"".join(s.frame for s in sigs)
+        if data: self.bytes += len(data); metrics.inc("chat_stream_bytes_total", (("transport", self.transport),), len(data))
+        return data
+    def batch(self, entries):
+        data = b"".join(self.encode(e) for e in entries) if self.encode else b"".join(e.frame for e in entries)
+        self.messages += len(entries); self.writes += 1; self.bytes += len(data); self.wrote = time.monotonic()
+        labels = (("transport", self.transport),); metrics.inc("chat_stream_bytes_total", labels, len(data))
+        if self.live: metrics.observe("chat_fanout_lag_seconds", time.monotonic() - entries[0].at, labels)   # a backlog isn't lag
+        return data
+    def ping(self):
+        # Called by heartbeats. False when the socket won't take the ping right now: it
+        # is closed, or its send buffer is full. Skipped while a write is under way,
+        # as that write has its own timeout. An SSE client never sends after its
+        # request, so anything readable there is the end of the connection.
+        if not self.lock.acquire(blocking=False): return True
+        try:
+            readable, writable = socket_ready(self.sock)
+            if readable and self.transport == "sse" or not writable: return False
+            data = self.PING[self.transport]
+            if self.sock.send(data) != len(data): return False
+        except (OSError, ValueError): return False
+        finally: self.lock.release()
+        self.pings += 1; self.wrote = time.monotonic(); metrics.inc("chat_heartbeats_total", (("transport", self.transport),))
+        return True
+    def reap(self):
+        metrics.inc("chat_streams_reaped_total", (("transport", self.transport),)); self.close()
+    def close(self):
+        # Shutting the socket down fails the engine's next read or write; on_reap
+        # wakes an engine that is only waiting for messages.
+        self.reaped = True
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        if self.on_reap: self.on_reap()
+    def stats(self):
+        return {"room": self.room, "transport": self.transport, "seconds": int(time.time() - self.started),
+                "messages": self.messages, "writes": self.writes, "bytes": self.bytes, "missed": self.missed, "pings": self.pings,
+                "ratio": round(self.messages / self.writes, 2) if self.writes else 0}
+
+streams = set()   # open SSEStream objects
+
+class TimerWheel:
+    # Hashed timer wheel: an item due in n ticks goes in slot (now + n) % len(slots),
+    # with the number of full turns it still has to wait. Adding, removing and
+    # expiring an item are O(1), and a tick only visits the items in one slot.
+    def __init__(self, slots): self.slots = [{} for _ in range(slots)]; self.where = {}; self.now = 0
+    def add(self, item, ticks):
+        self.remove(item); ticks = max(1, ticks); i = (self.now + ticks) % len(self.slots)
+        self.slots[i][item] = (ticks - 1) // len(self.slots); self.where[item] = i
+    def remove(self, item):
+        i = self.where.pop(item, None)
+        if i is not None: del self.slots[i][item]
+    def advance(self):
+        # Moves one tick on and returns the items that came due.
+        self.now += 1; slot = self.slots[self.now % len(self.slots)]; due = []
+        for item, turns in list(slot.items()):
+            if turns: slot[item] = turns - 1
+            else: del slot[item]; del self.where[item]; due.append(item)
+        return due
+
+class Heartbeats:
+    # Keeps every /stream and /ws alive from one thread instead of a timer per
+    # connection. A stream that wrote nothing for HEARTBEAT_INTERVAL gets a ping (an
+    # SSE comment or a ping frame), so idle proxies and NATs keep it open; one that
+    # can't take the ping is reaped. HEARTBEAT_ACK_TIMEOUT turns a peer that vanished
+    # behind a NAT into a socket error by the next ping instead of after many minutes.
+    def __init__(self):
+        self.lock = threading.Lock(); self.live = set(); self.thread = None
+        self.wheel = TimerWheel(max(1, round(HEARTBEAT_INTERVAL / HEARTBEAT_TICK)))
+
+    def add(self, st):
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            try: st.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, HEARTBEAT_ACK_TIMEOUT * 1000)
+            except OSError: pass
+        with self.lock:
+            self.live.add(st); self.wheel.add(st, self.ticks(HEARTBEAT_INTERVAL))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="heartbeats", daemon=True); self.thread.start()
+
+    def remove(self, st):
+        with self.lock: self.live.discard(st); self.wheel.remove(st)
+
+    def ticks(self, seconds): return max(1, round(seconds / HEARTBEAT_TICK))
+
+    def run(self):
+        due_at = time.monotonic()
+        while True:
+            due_at += HEARTBEAT_TICK; time.sleep(max(0, due_at - time.monotonic()))
+            with self.lock: due = self.wheel.advance()
+            for st in due:
+                idle = time.monotonic() - st.wrote
+                if idle < HEARTBEAT_INTERVAL: wait = HEARTBEAT_INTERVAL - idle   # it wrote since; come back once it's been quiet long enough
+                elif st.ping(): wait = HEARTBEAT_INTERVAL
+                else: st.reap(); self.remove(st); continue
+                with self.lock:
+                    if st in self.live: self.wheel.add(st, self.ticks(wait))
+
+heartbeats = Heartbeats()
+
+class Presence:
+    # Who is connected to each room (room.online) and the room's calls (room.calls),
+    # kept from the /stream and /ws connections themselves (their ?user=). Changes go
+    # out on the room's signal channel as small "presence" deltas (op join, leave, call,
+    # call-end); a new stream first gets the whole state (op state). A user whose last
+    # stream closes stays online for PRESENCE_GRACE, then leaves and ends the calls they
+    # started; calls also expire after CALL_TTL. Expiry runs on a TimerWheel, 1s ticks.
+    # The state lives where messages are sequenced: a bus follower forwards its streams
+    # and calls to the hub and keeps a copy from the hub's signals (see mirror).
+    def __init__(self): self.lock = threading.Lock(); self.wheel = TimerWheel(64); self.thread = None
+
+    def state(self, room):
+        # Callers hold lock.
+        return {"op": "state", "users": list(room.online), "calls": list(room.calls.values())}
+
+    def attach(self, room):
+        # A new stream's starting point: ([state signal], n), after which it wants the signals past n.
+        with self.lock:
+            with room.cond: n = room.signal_n
+            return [make_signal(n, "presence", self.state(room))], n
+
+    def join(self, room, user):
+        if not user: return
+        if not bus.sequencer: return bus.present(room, user, 1)
+        with self.lock:
+            self.wheel.remove(("leave", room, user))
+            known = user in room.online; room.online[user] = room.online.get(user, 0) + 1
+            if not known: room.signal("presence", {"op": "join", "user": user})
+
+    def leave(self, room, user):
+        if not user: return
+        if not bus.sequencer: return bus.present(room, user, -1)
+        with self.lock:
+            if not room.online.get(user): return
+            room.online[user] -= 1
+            if not room.online[user]: self.after(("leave", room, user), PRESENCE_GRACE)
+
+    def start_call(self, room, call):
+        if not bus.sequencer: return bus.send({"op": "call", "room": room.name, "call": call})
+        with self.lock:
+            room.calls[call["callId"]] = call; self.after(("call", room, call["callId"]), CALL_TTL)
+            room.signal("presence", {"op": "call", "call": call})
+
+    def end_call(self, room, call_id):
+        # Ends the call, if there is one, and says so in the room.
+        if not bus.sequencer: return bus.send({"op": "call-end", "room": room.name, "callId": call_id})
+        with self.lock:
+            call = room.calls.pop(call_id, None)
+            if call: self.wheel.remove(("call", room, call_id)); room.signal("presence", {"op": "call-end", "callId": call_id})
+        if call: room.publish(call_ended(call))
+
+    def calls(self, room):
+        with self.lock: return dict(room.calls)
+
+    def mirror(self, room, data):
+        # On a bus follower: applies a presence signal from the hub and passes it on to the
+        # room's streams, unless it changes nothing (it crossed the snapshot it is part of).
+        op = data["op"]
+        with self.lock:
+            if op == "state": room.online = dict.fromkeys(data["users"], 1); room.calls = {c["callId"]: c for c in data["calls"]}; changed = True
+            elif op == "join": changed = data["user"] not in room.online; room.online[data["user"]] = 1
+            elif op == "leave": changed = room.online.pop(data["user"], None) is not None
+            elif op == "call": changed = data["call"]["callId"] not in room.calls; room.calls[data["call"]["callId"]] = data["call"]
+            elif op == "call-end": changed = room.calls.pop(data["callId"], None) is not None
+            else: changed = True
+            if changed: room.signal("presence", data)
+
+    def after(self, key, seconds):
+        # Callers hold lock.
+        self.wheel.add(key, round(seconds))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="presence", daemon=True); self.thread.start()
+
+    def run(self):
+        due_at = time.monotonic()
+        while True:
+            due_at += 1; time.sleep(max(0, due_at - time.monotonic()))
+            with self.lock: due = self.wheel.advance()
+            for kind, room, key in due:
+                try: self.expire(kind, room, key)
+                except Exception: traceback.print_exc()
+
+    def expire(self, kind, room, key):
+        with self.lock:
+            if kind == "call": ended = [key]
+            elif room.online.get(key) != 0: return   # back within the grace period
+            else:
+                del room.online[key]; room.signal("presence", {"op": "leave", "user": key})
+                ended = [c["callId"] for c in room.calls.values() if c["users"][0] == key]
+        for call_id in ended: self.end_call(room, call_id)
+
+presence = Presence()
+
+class Typing:
+    # Who is typing in each room (room.typing), sent as "typing" signals with the
+    # whole list. A typing event only sets the user's expiry, and marks the room
+    # dirty if they weren't typing yet; one thread sends each dirty room's list at
+    # most once per TYPING_INTERVAL and drops users quiet for TYPING_TTL. However
+    # many people type, a room gets at most one small event per interval. Like
+    # presence, this runs where messages are sequenced; bus followers forward.
+    def __init__(self): self.lock = threading.Lock(); self.active = set(); self.dirty = set(); self.thread = None
+
+    def typing(self, room, user):
+        if not bus.sequencer: return bus.send({"op": "typing", "room": room.name, "user": user})
+        with self.lock:
+            if user not in room.typing: self.dirty.add(room)
+            room.typing[user] = time.monotonic() + TYPING_TTL; self.active.add(room)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="typing", daemon=True); self.thread.start()
+
+    def on_message(self, room, e):
+        # A msg listener: whoever sends a text message has stopped typing. Under room.cond.
+        if room.typing and e.msg.get("type") == "text":
+            with self.lock:
+                if room.typing.pop(e.msg.get("user"), None) is not None: self.dirty.add(room)
+
+    def run(self):
+        while True:
+            time.sleep(TYPING_INTERVAL); now = time.monotonic()
+            with self.lock:
+                for room in list(self.active):
+                    stale = [u for u, t in room.typing.items() if t <= now]
+                    for u in stale: del room.typing[u]
+                    if stale: self.dirty.add(room)
+                    if not room.typing: self.active.discard(room)
+                out = [(room, list(room.typing)) for room in self.dirty]; self.dirty.clear()
+            for room, users in out:
+                room.signal("typing", {"users": users[:TYPING_SHOWN], "more": max(0, len(users) - TYPING_SHOWN)})
+
+typists = Typing()
+
+def catch_up_signals(room, n, sigs):
+    # What a stream that sent the signals up to n sends next, given the newer ones it
+    # got (oldest first): them, or a fresh presence state if some were lost on the way
+    # (a full queue, or more than SIGNAL_BACKLOG). Returns (signals, new n).
+    sigs = [s for s in sigs if s.n > n]
+    if sigs and sigs[0].n != n + 1: return presence.attach(room)
+    return sigs, sigs[-1].n if sigs else n
+
+def stream_gauges():
+    out = {("chat_streams", (("transport", t),)): 0 for t in ("sse", "ws")}
+    for st in list(streams): out[("chat_streams", (("transport", st.transport),))] += 1
+    out[("chat_rooms", ())] = len(rooms)
+    out[("chat_users_online", ())] = sum(len(r.online) for r in list(rooms.values()))
+    return out
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def ws_handshake(headers):
+    # Response headers for a valid RFC 6455 upgrade, else None. permessage-deflate is
+    # taken without context takeover, so every message compresses on its own and one
+    # compressed frame per message is shared by all connections in the room.
+    key = headers.get("Sec-WebSocket-Key")
+    if not key or headers.get("Upgrade","").lower() != "websocket" or headers.get("Sec-WebSocket-Version") != "13": return None
+    out = {"Upgrade": "websocket", "Connection": "Upgrade",
+           "Sec-WebSocket-Accept": base64.b64encode(hashlib.sha1(key.strip().encode() + WS_GUID).digest()).decode()}
+    offer = headers.get("Sec-WebSocket-Extensions","")
+    if WS_DEFLATE and "permessage-deflate" in offer and "server_max_window_bits" not in offer:
+        out["Sec-WebSocket-Extensions"] = "permessage-deflate; server_no_context_takeover; client_no_context_takeover"
+    return out
+
+def ws_frame(payload, opcode=0x1, rsv1=False):
+    b0 = 0x80 | (0x40 if rsv1 else 0) | opcode; n = len(payload)
+    if n < 126: return struct.pack("!BB", b0, n) + payload
+    if n < 65536: return struct.pack("!BBH", b0, 126, n) + payload
+    return struct.pack("!BBQ", b0, 127, n) + payload
+
+class WebSocket:
+    # Frame codec for one /ws connection; each engine does its own socket I/O.
+    def __init__(self, deflate): self.deflate = deflate; self.buf = b""; self.parts = []; self.first = None
+
+    def feed(self, data):
+        # Complete inbound messages as (opcode, payload); control frames as they arrive.
+        self.buf += data; out = []
+        while len(self.buf) >= 2:
+            buf = self.buf; b0, b1 = buf[0], buf[1]; n = b1 & 0x7f; i = 2
+            if n == 126:
+                if len(buf) < 4: break
+                n = struct.unpack_from("!H", buf, 2)[0]; i = 4
+            elif n == 127:
+                if len(buf) < 10: break
+                n = struct.unpack_from("!Q", buf, 2)[0]; i = 10
+            if not b1 & 0x80 or n > WS_MAX_MESSAGE: raise ValueError("unmasked or oversized frame")
+            if len(buf) < i + 4 + n: break
+            mask = buf[i:i+4]; payload = buf[i+4:i+4+n]; self.buf = buf[i+4+n:]
+            if n: payload = (int.from_bytes(payload, "big") ^ int.from_bytes((mask * (n//4 + 1))[:n], "big")).to_bytes(n, "big")
+            opcode = b0 & 0x0f
+            if opcode >= 0x8: out.append((opcode, payload)); continue
+            if opcode: self.first = (opcode, b0 & 0x40); self.parts = []
+            elif self.first is None: raise ValueError("continuation without a message")
+            self.parts.append(payload)
+            if sum(map(len, self.parts)) > WS_MAX_MESSAGE: raise ValueError("oversized message")
+            if b0 & 0x80:
+                (opcode, compressed), payload = self.first, b"".join(self.parts); self.first = None
+                if compressed:
+                    if not self.deflate: raise ValueError("compressed frame without permessage-deflate")
+                    payload = zlib.decompressobj(-15).decompress(payload + b"\x00\x00\xff\xff", WS_MAX_MESSAGE)
+                out.append((opcode, payload))
+        return out
+
+    def message(self, e):
+        # Outbound frame for an entry, built once per entry and shared by every connection.
+        key = "wsz" if self.deflate else "ws"; f = e.cache.get(key)
+        if f is None:
+            if self.deflate:
+                c = zlib.compressobj(6, zlib.DEFLATED, -15); f = ws_frame((c.compress(e.json) + c.flush(zlib.Z_SYNC_FLUSH))[:-4], rsv1=True)
+            else: f = ws_frame(e.json)
+            e.cache[key] = f
+        return f
+
+def ws_action(room, payload, ip):
+    # Inbound /ws message: {"op": "send" | "send-emoji" | ... (see ACTIONS), plus the POST body's fields}.
+    # There is no reply, so one over the rate limit is dropped.
+    try:
+        data = json.loads(payload); op = data.get("op"); action = ACTIONS.get(op)
+        if action and not limiter.take(RATE_CLASS[op], ip, display_name(data)): action(room, data)
+    except (ValueError, AttributeError, BusUnavailable): pass
+
+def stream_user(q): return str(q.get("user", [""])[0])[:30].strip()   # for presence; empty for anonymous streams
+
+def stream_cursor(room, q, headers):
+    # Last-Event-ID (sent by EventSource on reconnect) wins over ?after=; default is "only new messages".
+    # A cursor ahead of the log means the server restarted, so replay what we have.
+    with room.cond: head = room.messages.seq
+    for v in (headers.get("Last-Event-ID"), q.get("after",[None])[0]):
+        try: last = max(0, int(v))
+        except (TypeError, ValueError): continue
+        return last if last <= head else 0
+    return head
+
+MARKUP = re.compile(r"<[^>]*>")
+
+def search_terms(text):
+    # Lowercased words of a message, with stored HTML markup (uploads, stickers) dropped.
+    return re.findall(r"\w+", html.unescape(MARKUP.sub(" ", text)).lower())
+
+class SearchIndex:
+    # Inverted index of one room: term -> seqs, ascending. Users and message types are
+    # terms too ("u:<user>", "t:<type>"). seqs/ts map a time range to a seq range;
+    # ts is kept non-decreasing so it can be bisected.
+    def __init__(self):
+        self.postings = {}; self.seqs = array("Q"); self.ts = array("Q"); self.last = 0; self.lock = threading.Lock()
+
+    def add(self, msg):
+        seq = msg["seq"]
+        if seq <= self.last: return
+        terms = set(t for t in search_terms(str(msg.get("text",""))) if len(t) <= 64)
+        terms.add("u:" + str(msg.get("user","")).lower()); terms.add("t:" + str(msg.get("type","")))
+        with self.lock:
+            for t in terms:
+                p = self.postings.get(t)
+                if p is None: p = self.postings[t] = array("Q")
+                p.append(seq)
+            self.seqs.append(seq); self.ts.append(max(int(msg.get("ts") or 0), self.ts[-1] if self.ts else 0)); self.last = seq
+
+    def query(self, terms, since, until, before, limit):
+        # Seqs below before, in [since, until] (ms), carrying every term; newest first.
+        # The rarest term drives, the others are probed by bisection.
+        with self.lock:
+            lo = bisect.bisect_left(self.ts, since) if since else 0; hi = bisect.bisect_right(self.ts, until) if until else len(self.ts)
+            if lo >= hi: return []
+            lo, hi = self.seqs[lo], min(self.seqs[hi-1], before - 1)
+            lists = [self.postings.get(t) for t in terms] or [self.seqs]
+            if not all(lists): return []
+            lists.sort(key=len); drive, rest = lists[0], lists[1:]; out = []
+            i = bisect.bisect_right(drive, hi)
+            while i and len(out) < limit:
+                i -= 1; s = drive[i]
+                if s < lo: break
+                if all((j := bisect.bisect_left(p, s)) < len(p) and p[j] == s for p in rest): out.append(s)
+            return out
+
+class Search:
+    # Keeps a SearchIndex per room. Messages reach it through msg_listeners, which
+    # only queue them: indexing happens on one thread of its own, and queries take
+    # the index's lock, never room.cond. A room's index is first built from its
+    # journal and in-memory window, the first time it gets a message or a query.
+    def __init__(self):
+        self.indexes = {}; self.pending = []; self.cond = threading.Condition(); self.thread = None
+
+    def on_message(self, room, e): self.enqueue(room, e.msg)
+
+    def drop(self, room):
+        # Forgets the room's index (its seqs started over); it is rebuilt on next use.
+        with self.cond: self.indexes.pop(room.name, None)
+
+    def enqueue(self, room, msg):
+        with self.cond:
+            self.pending.append((room, msg)); self.cond.notify_all()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="search", daemon=True); self.thread.start()
+
+    def index(self, room):
+        # The room's index, or None if it isn't built within SEARCH_BUILD_WAIT.
+        idx = self.indexes.get(room.name)
+        if idx is None:
+            self.enqueue(room, None); end = time.time() + SEARCH_BUILD_WAIT
+            with self.cond:
+                while (idx := self.indexes.get(room.name)) is None and time.time() < end: self.cond.wait(end - time.time())
+        return idx
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending: self.cond.wait()
+                batch, self.pending = self.pending, []
+            for room, msg in batch:
+                try:
+                    idx = self.indexes.get(room.name) or self.build(room)
+                    if msg is None: continue
+                    if msg["seq"] > idx.last + 1: self.catch_up(room, idx)   # a bus resync skipped the listeners
+                    idx.add(msg)
+                except Exception: traceback.print_exc()
+
+    def build(self, room):
+        idx = SearchIndex()
+        if room.journal:
+            for msg in room.journal.replay(): idx.add(msg)
+        self.catch_up(room, idx)
+        with self.cond: self.indexes[room.name] = idx; self.cond.notify_all()
+        return idx
+
+    def catch_up(self, room, idx):
+        with room.cond: window = [e.msg for e in room.messages.since(idx.last)]
+        for msg in window: idx.add(msg)
+
+search = Search()
+
 def local_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.connect(("8.8.8.8", 80))
@@ -196,462 +1300,534 @@ def get_file_icon(filename):
     }
     return icons.get(ext, '📎')
 
-class ChatHandler(http.server.BaseHTTPRequestHandler):
-    def _set_headers(self,status=200,extra=None,ctype="text/html; charset=utf-8"):
-        self.send_response(status); self.send_header("Content-Type",ctype)
-        self.send_header("Cache-Control","no-store, no-cache, must-revalidate")
-        if extra: [self.send_header(k,v) for k,v in extra.items()]
-        self.end_headers()
-    def log_message(self,fmt,*a): sys.stdout.write("[%s] %s\n"%(self.address_string(),fmt%a))
+class MultipartParser:
+    # Incremental multipart/form-data parser. The body is read in UPLOAD_CHUNK pieces
+    # and file parts go straight to temp files in UPLOAD_DIR, hashed on the way, so memory
+    # use per upload stays constant regardless of file size. Part data is cut exactly at the boundary.
+    MAX_FIELD = 64 * 1024
+    MAX_HEADERS = 16 * 1024
 
-    def do_GET(self):
-        p = urllib.parse.urlparse(self.path)
-        if p.path == "/": return self.page()
-        if p.path == "/stream": return self.sse()
-        if p.path == "/history":
-            self._set_headers(200,ctype="application/json"); 
-            with msg_cond: self.wfile.write(json.dumps(list(messages)).encode())
-        elif p.path == "/emojis":
-            emojis = {}
-            for f in os.listdir(EMOJI_DIR):
-                if f.endswith('.txt'):
-                    try:
-                        with open(os.path.join(EMOJI_DIR, f), 'r', encoding="utf-8") as ef:
-                            emojis[f[:-4]] = ef.read().strip()
-                    except:
-                        continue
-            self._set_headers(200,ctype="application/json")
-            self.wfile.write(json.dumps(emojis).encode())
-        elif p.path == "/stickers":
-            stickers = {}
-            for f in os.listdir(STICKER_DIR):
-                if f.endswith('.txt'):
-                    name = os.path.splitext(f)[0]
-                    try:
-                        with open(os.path.join(STICKER_DIR, f), 'r', encoding="utf-8") as sf:
-                            stickers[name] = sf.read().strip()
-                    except:
-                        continue
-            self._set_headers(200,ctype="application/json")
-            self.wfile.write(json.dumps(stickers).encode())
-        elif p.path.startswith("/uploads/"):
-            return self.serve_file(p.path[1:])
-        elif p.path.startswith("/" + STICKER_DIR + "/"):
-            return self.serve_file(p.path[1:])
-        elif p.path == "/call-status":
-            return self.get_call_status()
-        else:
-            self._set_headers(404,ctype="text/plain"); self.wfile.write(b"Not found")
+    def __init__(self, rfile, boundary, length):
+        self.rfile = rfile; self.remaining = length
+        self.delim = b"\r\n--" + boundary
+        self.buf = b"\r\n"   # lets the first boundary match the same delimiter as the rest
 
-    def do_POST(self):
-        if self.path == "/send": return self.handle_text()
-        if self.path == "/upload": return self.handle_upload()
-        if self.path == "/start-call": return self.start_call()
-        if self.path == "/end-call": return self.end_call()
-        if self.path == "/send-emoji": return self.handle_emoji()
-        if self.path == "/send-sticker": return self.handle_sticker()
-        self._set_headers(404,ctype="text/plain")
+    def fill(self):
+        if self.remaining <= 0: raise ValueError("truncated multipart body")
+        chunk = self.rfile.read(min(UPLOAD_CHUNK, self.remaining))
+        if not chunk: raise ValueError("connection closed mid-upload")
+        self.remaining -= len(chunk); self.buf += chunk
 
-    def handle_text(self):
-        ln = int(self.headers.get("Content-Length",0)); data = urllib.parse.parse_qs(self.rfile.read(ln).decode())
-        user = (data.get("username",["Anon"])[0][:30]).strip() or "Anon"
-        text = (data.get("text",[""])[0]).strip()
-        if not text: self._set_headers(400,ctype="text/plain"); return
-        msg = {"user":user,"text":text,"ts":now_ms(),"type":"text"}
-        with msg_cond: messages.append(msg); msg_cond.notify_all()
-        self._set_headers(204,ctype="text/plain")
-
-    def handle_emoji(self):
-        ln = int(self.headers.get("Content-Length",0)); data = json.loads(self.rfile.read(ln).decode())
-        user = data.get("username", "Anon")[:30].strip() or "Anon"
-        emoji = data.get("emoji", "")
-        if not emoji: self._set_headers(400,ctype="text/plain"); return
-        msg = {"user":user,"text":emoji,"ts":now_ms(),"type":"emoji"}
-        with msg_cond: messages.append(msg); msg_cond.notify_all()
-        self._set_headers(200,ctype="application/json")
-        self.wfile.write(json.dumps({"status":"sent"}).encode())
-
-    def handle_sticker(self):
-        ln = int(self.headers.get("Content-Length",0)); data = json.loads(self.rfile.read(ln).decode())
-        user = data.get("username", "Anon")[:30].strip() or "Anon"
-        sticker = data.get("sticker", "")
-        if not sticker: self._set_headers(400,ctype="text/plain"); return
-        # Format sticker as a nice message
-        sticker_msg = f"""
-        <div style="background:linear-gradient(135deg,#667eea,#764ba2);padding:15px;border-radius:20px;text-align:center;color:white;font-weight:bold;font-size:18px;max-width:200px;margin:5px 0;">
-            {sticker}
-        </div>
-        """
-        msg = {"user":user,"text":sticker_msg,"ts":now_ms(),"type":"sticker"}
-        with msg_cond: messages.append(msg); msg_cond.notify_all()
-        self._set_headers(200,ctype="application/json")
-        self.wfile.write(json.dumps({"status":"sent"}).encode())
+    def parse(self):
+        # Returns ({field: value}, [(filename, temp_path, sha256, size)]); temp files are removed on error.
+        fields, files = {}, []
+        try:
+            self.skip_to_delim()
+            while True:
+                while len(self.buf) < 2: self.fill()
+                if self.buf[:2] == b"--": break
+                name, filename = self.read_part_headers()
+                if filename == "":   # a file input left empty still sends its part; there is no file
+                    self.copy_part(io.BytesIO(), self.MAX_FIELD)
+                elif filename is None:
+                    out = io.BytesIO(); self.copy_part(out, self.MAX_FIELD)
+                    fields[name] = out.getvalue().decode("utf-8", "replace")
+                else:
+                    fd, tmp = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=".upload-")
+                    files.append((filename, tmp)); h = hashlib.sha256()
+                    with os.fdopen(fd, "wb") as out: size = self.copy_part(out, h=h)
+                    files[-1] = (filename, tmp, h.hexdigest(), size)
+            return fields, files
+        except BaseException:
+            for _, tmp, *_ in files:
+                try: os.remove(tmp)
+                except OSError: pass
+            raise
 
-    def handle_upload(self):
-        ctype = self.headers.get("Content-Type","")
-        if not ctype.startswith("multipart/form-data"):
-            self._set_headers(400,ctype="text/plain"); return
-        boundary = ctype.split("boundary=")[-1].encode()
-        length = int(self.headers.get("Content-Length",0))
-        body = self.rfile.read(length)
+    def skip_to_delim(self):
+        while True:
+            i = self.buf.find(self.delim)
+            if i >= 0: self.buf = self.buf[i+len(self.delim):]; return
+            self.buf = self.buf[-len(self.delim):]; self.fill()
 
-        parts = body.split(b"--"+boundary)
-        for part in parts:
-            if b"Content-Disposition" in part:
-                header, filedata = part.split(b"\r\n\r\n",1) if b"\r\n\r\n" in part else (part, b"")
-                filedata = filedata.rstrip(b"\r\n-")
-                
-                # Get filename
-                filename_match = re.search(br'filename="([^"]+)"', header)
-                if not filename_match: 
-                    # Check for username
-                    um = re.search(br'name="username"\r\n\r\n([^-\r\n]+)', part)
-                    if um: user = um.group(1).decode().strip() or "Anon"
-                    continue
-                    
-                fname = filename_match.group(1).decode().replace(" ","_")
-                fpath = os.path.join(UPLOAD_DIR,f"{int(time.time())}_{fname}")
-                with open(fpath,"wb") as f: f.write(filedata)
-                url = "/"+fpath.replace("\\","/")
-                
-                # Determine file type and create appropriate message
-                ext = os.path.splitext(fname)[1].lower()
-                if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-                    content = f"<img src='{url}' style='max-width:200px;border-radius:8px;cursor:pointer' onclick='window.open(this.src)'/>"
-                    msg_type = "image"
-                elif ext in ['.mp4', '.avi', '.mov', '.mkv', '.webm']:
-                    content = f"""
-                    <video controls style='max-width:200px;border-radius:8px;'>
-                        <source src='{url}' type='video/mp4'>
-                        Your browser does not support the video tag.
-                    </video>
-                    """
-                    msg_type = "video"
-                elif ext in ['.mp3', '.wav', '.ogg', '.m4a']:
-                    content = f"""
-                    <audio controls style='width:200px;'>
-                        <source src='{url}' type='audio/mpeg'>
-                        Your browser does not support the audio tag.
-                    </audio>
-                    <span style='font-size:12px;color:#888;'>🎵 Audio file</span>
-                    """
-                    msg_type = "audio"
-                else:
-                    icon = get_file_icon(fname)
-                    content = f"{icon} <a href='{url}' download='{fname}' style='color:#00a884;text-decoration:none;'>Download {fname}</a>"
-                    msg_type = "file"
-                
-                msg = {"user":user,"text":content,"ts":now_ms(),"type":msg_type}
-                with msg_cond: messages.append(msg); msg_cond.notify_all()
-        self._set_headers(204,ctype="text/plain")
+    def read_part_headers(self):
+        while True:
+            i = self.buf.find(b"\r\n\r\n")
+            if i >= 0: break
+            if len(self.buf) > self.MAX_HEADERS: raise ValueError("part headers too long")
+            self.fill()
+        head = self.buf[:i].decode("utf-8", "replace"); self.buf = self.buf[i+4:]
+        name = re.search(r'\bname="([^"]*)"', head); filename = re.search(r'filename="([^"]*)"', head)
+        return (name.group(1) if name else ""), (filename.group(1) if filename else None)
 
-    def start_call(self):
-        length = int(self.headers.get("Content-Length",0))
-        data = json.loads(self.rfile.read(length).decode())
-        user = data.get("username", "Anon")
-        call_id = data.get("callId", str(int(time.time())))
-        
-        active_calls[call_id] = {
-            "users": [user],
-            "start_time": now_ms(),
-            "type": data.get("callType", "voice")
-        }
-        
-        # Notify all users about the call
-        msg = {
-            "user": "system", 
-            "text": f"📞 {user} started a {active_calls[call_id]['type']} call",
-            "ts": now_ms(),
-            "type": "system",
-            "callId": call_id
-        }
-        with msg_cond: messages.append(msg); msg_cond.notify_all()
-        
-        self._set_headers(200,ctype="application/json")
-        self.wfile.write(json.dumps({"callId": call_id, "status": "started"}).encode())
+    def copy_part(self, out, limit=None, h=None):
+        # Writes everything up to the next delimiter, keeping back a tail that might be its prefix.
+        # Returns the number of bytes written.
+        keep = len(self.delim) - 1; written = 0
+        while True:
+            i = self.buf.find(self.delim)
+            data = self.buf[:i] if i >= 0 else self.buf[:max(0, len(self.buf)-keep)]
+            written += len(data)
+            if limit is not None and written > limit: raise ValueError("form field too long")
+            out.write(data)
+            if h: h.update(data)
+            if i >= 0: self.buf = self.buf[i+len(self.delim):]; return written
+            self.buf = self.buf[len(data):]; self.fill()
 
-    def end_call(self):
-        length = int(self.headers.get("Content-Length",0))
-        data = json.loads(self.rfile.read(length).decode())
-        call_id = data.get("callId")
-        user = data.get("username", "Anon")
-        
-        if call_id in active_calls:
-            duration = (now_ms() - active_calls[call_id]["start_time"]) // 1000
-            del active_calls[call_id]
-            
-            # Notify all users about call end
-            msg = {
-                "user": "system", 
-                "text": f"📞 Call ended (duration: {duration}s)",
-                "ts": now_ms(),
-                "type": "system"
-            }
-            with msg_cond: messages.append(msg); msg_cond.notify_all()
-        
-        self._set_headers(200,ctype="application/json")
-        self.wfile.write(json.dumps({"status": "ended"}).encode())
+class UploadStore:
+    # Content-addressed uploads. Files are stored once per distinct content, at
+    # blobs/<ab>/<cd>/<sha256>, and served as /uploads/<sha256>/<name>; the bytes behind
+    # such a URL never change. The index file records which message refers to which blob.
+    def __init__(self, root, index):
+        self.root = root; self.index = index
+        old = os.path.join(root, "index.jsonl")   # where earlier versions kept it, inside the served directory
+        if os.path.exists(old) and not os.path.exists(index): os.replace(old, index)
 
-    def get_call_status(self):
-        self._set_headers(200,ctype="application/json")
-        self.wfile.write(json.dumps(active_calls).encode())
-
-    def serve_file(self, path):
-        fpath = os.path.join(".", path)
-        if not os.path.isfile(fpath): self._set_headers(404,ctype="text/plain"); self.wfile.write(b"Not found"); return
-        ctype = mimetypes.guess_type(fpath)[0] or "application/octet-stream"
-        self._set_headers(200,ctype=ctype)
-        with open(fpath,"rb") as f: self.wfile.write(f.read())
-
-    def page(self):
-        self._set_headers()
-        self.wfile.write(f"""<!doctype html>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<title>NewGen Tech Chat</title>
-<style>
-body{{margin:0;font-family:Segoe UI,Roboto,sans-serif;background:linear-gradient(135deg,#0f2027,#203a43,#2c5364);color:#fff;display:flex;flex-direction:column;height:100vh;}}
-header{{background:rgba(0,0,0,0.4);padding:12px 16px;font-size:18px;font-weight:bold;color:#fff;text-align:center;backdrop-filter:blur(4px);position:sticky;top:0;z-index:1;display:flex;justify-content:space-between;align-items:center;}}
-#log{{flex:1;overflow-y:auto;padding:10px;display:flex;flex-direction:column;gap:10px;}}
-.msg-wrap{{display:flex;align-items:flex-end;gap:8px;animation:fadeIn 0.3s ease;}}
-.me{{flex-direction:row-reverse;}}
-.avatar{{width:32px;height:32px;border-radius:50%;background:#00a884;display:flex;align-items:center;justify-content:center;font-size:14px;font-weight:bold;color:#fff;}}
-.bubble{{max-width:70%;padding:10px 14px;border-radius:14px;line-height:1.4;word-wrap:break-word;box-shadow:0 2px 4px rgba(0,0,0,0.3);background:rgba(255,255,255,0.1);}}
-.me .bubble{{background:#00a884;color:#fff;border-bottom-right-radius:4px;}}
-.other .bubble{{border-bottom-left-radius:4px;}}
-.meta{{font-size:11px;opacity:0.7;margin-top:4px;}}
-.system-msg{{text-align:center;color:#aaa;font-style:italic;margin:5px 0;}}
-.emoji-msg{{font-size:2em;text-align:center;padding:10px;}}
-.sticker-msg{{text-align:center;padding:5px;}}
-form{{display:flex;padding:10px;background:rgba(0,0,0,0.3);gap:8px;position:sticky;bottom:0;backdrop-filter:blur(4px);}}
-input,button{{padding:10px;border:none;border-radius:8px;font-size:15px;}}
-input[name=text]{{flex:1;}}
-button{{background:#00a884;color:#fff;cursor:pointer;}}
-.controls{{display:flex;gap:5px;}}
-.icon-btn{{background:none;border:none;color:#fff;font-size:18px;cursor:pointer;padding:5px;}}
-.picker{{position:absolute;bottom:60px;background:rgba(0,0,0,0.9);border-radius:10px;padding:10px;max-width:300px;max-height:200px;overflow-y:auto;display:none;flex-wrap:wrap;gap:5px;backdrop-filter:blur(10px);z-index:1000;}}
-.emoji{{font-size:24px;cursor:pointer;padding:5px;transition:transform 0.2s;}}
-.emoji:hover{{transform:scale(1.2);}}
-.sticker{{padding:8px 12px;background:linear-gradient(135deg,#667eea,#764ba2);border-radius:15px;cursor:pointer;color:white;font-weight:bold;text-align:center;min-width:80px;transition:transform 0.2s;}}
-.sticker:hover{{transform:scale(1.05);}}
-.recorder{{display:none;position:fixed;top:50%;left:50%;transform:translate(-50%,-50%);background:rgba(0,0,0,0.9);padding:20px;border-radius:10px;z-index:1000;}}
-.call-ui{{position:fixed;top:10px;right:10px;background:rgba(0,0,0,0.8);padding:10px;border-radius:10px;z-index:999;}}
-@keyframes fadeIn{{from{{opacity:0;transform:translateY(5px);}}to{{opacity:1;transform:translateY(0);}}}}
-.typing{{font-style:italic;color:#aaa;font-size:12px;padding:5px 10px;}}
-.recording-animation{{animation:pulse 1s infinite;}}
-@keyframes pulse{{0%{{opacity:1;}}50%{{opacity:0.5;}}100%{{opacity:1;}}}}
-</style>
-<header>
-    <span>💬 NewGen Tech Chat</span>
-    <div class="controls">
-        <button class="icon-btn" onclick="toggleEmojiPicker()">😀</button>
-        <button class="icon-btn" onclick="toggleStickerPicker()">🖼️</button>
-        <button class="icon-btn" onclick="toggleVoiceCall()">📞</button>
-        <button class="icon-btn" onclick="toggleVideoCall()">🎥</button>
-    </div>
-</header>
-<div id="log"></div>
-<div id="typing"></div>
-<form id="f" enctype="multipart/form-data">
-<input name="username" placeholder="Name" required style="max-width:120px">
-<input name="text" placeholder="Type a message..." autocomplete="off" id="textInput">
-<input type="file" name="file" accept="*/*" id="fileInput" style="display:none">
-<button type="button" onclick="document.getElementById('fileInput').click()">📎</button>
-<button type="button" id="recordBtn" onclick="toggleRecording()">🎤</button>
-<button type="submit">Send</button>
-</form>
+    def blob(self, digest): return "/".join(("blobs", digest[:2], digest[2:4], digest))   # relative to root
 
-<div id="emojiPicker" class="picker"></div>
-<div id="stickerPicker" class="picker"></div>
-<div id="recorder" class="recorder">
-    <h3>🎤 Recording...</h3>
-    <div style="display:flex;align-items:center;gap:10px;margin:10px 0;">
-        <div id="recordingIndicator" style="width:20px;height:20px;background:red;border-radius:50%;animation:pulse 1s infinite;"></div>
-        <span>Recording in progress</span>
-    </div>
-    <button onclick="stopRecording()" style="background:#00a884;">Stop & Send</button>
-    <button onclick="cancelRecording()" style="background:#666;">Cancel</button>
-</div>
+    def put(self, tmp, digest):
+        # Moves a hashed temp file into place; True if the content is new. A duplicate
+        # costs nothing beyond the temp file, which is dropped.
+        fpath = os.path.join(self.root, self.blob(digest))
+        if os.path.exists(fpath): os.remove(tmp); return False
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        os.replace(tmp, fpath); return True
 
-<div id="callUI" class="call-ui" style="display:none">
-    <div id="callInfo"></div>
-    <button onclick="endCall()">End Call</button>
-</div>
+    def link(self, room, msg, digest, name, size):
+        # One line per upload message. O_APPEND keeps lines whole across --workers processes.
+        line = json.dumps({"room": room.name, "user": msg["user"], "ts": msg["ts"], "seq": msg.get("seq"),
+                           "sha256": digest, "name": name, "size": size}).encode() + b"\n"
+        with open(self.index, "ab") as f: f.write(line)
+
+upload_store = UploadStore(UPLOAD_DIR, UPLOAD_INDEX)
+UPLOAD_URL = re.compile(r"/uploads/([0-9a-f]{64})/([^/]+)")
+LEGACY_UPLOAD = re.compile(r"\d+_[^/\\]+")   # <unixtime>_<name>, the only files directly under UPLOAD_DIR that are served
+
+# Upload post-processing runs on media_pool, off the request path. The type comes
+# from magic bytes (the extension is only a fallback), plus whatever the headers
+# give away cheaply: image dimensions, WAV / WebM / MP4 duration.
+
+def png_size(b): return struct.unpack_from(">II", b, 16) if b[12:16] == b"IHDR" else None
+
+def gif_size(b): return struct.unpack_from("<HH", b, 6)
+
+def jpeg_size(b):
+    i = 2
+    while i + 9 < len(b) and b[i] == 0xff:
+        marker = b[i+1]
+        if marker == 0xff: i += 1; continue   # fill byte
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):   # SOFn
+            h, w = struct.unpack_from(">HH", b, i+5); return w, h
+        i += 2 + struct.unpack_from(">H", b, i+2)[0]
+    return None
+
+def wav_duration(b):
+    i = 12; byte_rate = None
+    while i + 8 <= len(b):
+        cid, n = b[i:i+4], struct.unpack_from("<I", b, i+4)[0]
+        if cid == b"fmt ": byte_rate = struct.unpack_from("<I", b, i+16)[0]
+        if cid == b"data": return n / byte_rate if byte_rate else None
+        i += 8 + n + (n & 1)
+    return None
+
+def ebml_vint(b, i, marker=False):
+    # EBML variable-length int at i -> (value, next i); element IDs keep their marker bit.
+    # A size of all ones ("unknown", used by live MediaRecorder output) comes back as -1.
+    n = 1
+    while n < 8 and not b[i] & (0x80 >> (n-1)): n += 1
+    v = b[i] if marker else b[i] & (0xff >> n)
+    for j in range(1, n): v = v << 8 | b[i+j]
+    return (-1 if not marker and v == (1 << 7*n) - 1 else v), i + n
+
+def webm_info(b):
+    # (duration, has video) from Segment/Info and Segment/Tracks; clusters are skipped.
+    info = {"scale": 1000000, "duration": None, "video": False}
+    def walk(i, end):
+        while i < end:
+            eid, i = ebml_vint(b, i, True); n, i = ebml_vint(b, i)
+            if n < 0: n = len(b) - i
+            if eid in (0x18538067, 0x1549a966, 0x1654ae6b, 0xae): walk(i, min(i+n, len(b)))   # Segment, Info, Tracks, TrackEntry
+            elif eid == 0x2ad7b1: info["scale"] = int.from_bytes(b[i:i+n], "big")
+            elif eid == 0x4489: info["duration"] = struct.unpack(">f" if n == 4 else ">d", b[i:i+n])[0]
+            elif eid == 0x83 and b[i] == 1: info["video"] = True   # TrackType 1 = video
+            i += n
+    walk(0, len(b))
+    d = info["duration"]
+    return (d * info["scale"] / 1e9 if d else None), info["video"]
+
+def mp4_info(f, size):
+    # (duration, has video) from moov/mvhd. moov is often at the end, so top-level boxes are seeked over.
+    pos = 0
+    while pos + 8 <= size:
+        f.seek(pos); n, kind = struct.unpack(">I4s", f.read(8)); head = 8
+        if n == 1: n = struct.unpack(">Q", f.read(8))[0]; head = 16
+        elif n == 0: n = size - pos
+        if n < head: break
+        if kind == b"moov":
+            moov = f.read(min(n - head, MEDIA_SNIFF_BYTES)); i = 0; duration = None
+            while i + 8 <= len(moov):
+                cn, ck = struct.unpack_from(">I4s", moov, i)
+                if ck == b"mvhd":
+                    scale, d = struct.unpack_from(">IQ", moov, i+28) if moov[i+8] == 1 else struct.unpack_from(">II", moov, i+20)
+                    duration = d / scale if scale else None; break
+                if cn < 8: break
+                i += cn
+            return duration, b"vide" in moov   # hdlr of the first track(s)
+        pos += n
+    return None, True
+
+def sniff(path, name):
+    # {"mime", "kind": image|video|audio|file, and "width"/"height" or "duration" when known}
+    mime = dims = duration = None
+    with open(path, "rb") as f:
+        b = f.read(MEDIA_SNIFF_BYTES)
+        try:
+            if b[:8] == b"\x89PNG\r\n\x1a\n": mime, dims = "image/png", png_size(b)
+            elif b[:6] in (b"GIF87a", b"GIF89a"): mime, dims = "image/gif", gif_size(b)
+            elif b[:3] == b"\xff\xd8\xff": mime, dims = "image/jpeg", jpeg_size(b)
+            elif b[:4] == b"RIFF" and b[8:12] == b"WEBP": mime = "image/webp"
+            elif b[:4] == b"RIFF" and b[8:12] == b"WAVE": mime, duration = "audio/wav", wav_duration(b)
+            elif b[:4] == b"\x1a\x45\xdf\xa3":
+                duration, video = webm_info(b)
+                mime = ("video/" if video else "audio/") + ("webm" if b"webm" in b[:64] else "x-matroska")
+            elif b[4:8] == b"ftyp":
+                duration, video = mp4_info(f, os.fstat(f.fileno()).st_size); mime = "video/mp4" if video else "audio/mp4"
+            elif b[:4] == b"OggS": mime = "audio/ogg"
+            elif b[:3] == b"ID3" or b[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"): mime = "audio/mpeg"
+            elif b[:4] == b"%PDF": mime = "application/pdf"
+        except (IndexError, struct.error, ValueError): pass   # truncated or unusual headers
+    mime = mime or mimetypes.guess_type(name)[0] or "application/octet-stream"
+    kind = mime.split("/")[0]; info = {"mime": mime, "kind": kind if kind in ("image", "video", "audio") else "file"}
+    if dims: info["width"], info["height"] = dims
+    if duration: info["duration"] = round(duration, 2)
+    return info
+
+def media_html(url, fname, info):
+    kind, mime = info["kind"], info["mime"]
+    length = "%d:%02d" % divmod(int(info["duration"]), 60) if "duration" in info else ""
+    if kind == "image":
+        dims = f" width='{info['width']}' height='{info['height']}'" if "width" in info else ""
+        return f"<img src='{url}'{dims} style='max-width:200px;height:auto;border-radius:8px;cursor:pointer' onclick='window.open(this.src)'/>"
+    if kind == "video":
+        return f"""
+                <video controls preload='metadata' style='max-width:200px;border-radius:8px;'>
+                    <source src='{url}' type='{mime}'>
+                    Your browser does not support the video tag.
+                </video>
+                """
+    if kind == "audio":
+        return f"""
+                <audio controls preload='metadata' style='width:200px;'>
+                    <source src='{url}' type='{mime}'>
+                    Your browser does not support the audio tag.
+                </audio>
+                <span style='font-size:12px;color:#888;'>🎵 {length or 'Audio file'}</span>
+                """
+    return f"{get_file_icon(fname)} <a href='{url}' download='{fname}' style='color:#00a884;text-decoration:none;'>Download {fname}</a>"
+
+def publish_uploads(room, user, files):
+    # One job per upload request, so its files are announced in order.
+    for fname, digest, size in files:
+        try:
+            info = sniff(os.path.join(upload_store.root, upload_store.blob(digest)), fname); info["size"] = size
+            msg = {"user":user,"text":media_html(f"/uploads/{digest}/{urllib.parse.quote(fname)}", fname, info),
+                   "ts":now_ms(),"type":info["kind"],"media":info}
+            room.publish(msg)   # sets msg["seq"] unless a bus hub sequences it
+            upload_store.link(room, msg, digest, fname, size)
+        except Exception: traceback.print_exc()
+
+media_pool = ThreadPoolExecutor(MEDIA_WORKERS, thread_name_prefix="media")
+
+# The chat page is rendered once at import time. CSS and JS are served from
+# content-hashed /static/ URLs that never change, so browsers cache them forever.
+PAGE_CSS = """body{margin:0;font-family:Segoe UI,Roboto,sans-serif;background:linear-gradient(135deg,#0f2027,#203a43,#2c5364);color:#fff;display:flex;flex-direction:column;height:100vh;}
+header{background:rgba(0,0,0,0.4);padding:12px 16px;font-size:18px;font-weight:bold;color:#fff;text-align:center;backdrop-filter:blur(4px);position:sticky;top:0;z-index:1;display:flex;justify-content:space-between;align-items:center;}
+#log{flex:1;overflow-y:auto;padding:10px;display:flex;flex-direction:column;gap:10px;}
+.msg-wrap{display:flex;align-items:flex-end;gap:8px;animation:fadeIn 0.3s ease;}
+.me{flex-direction:row-reverse;}
+.avatar{width:32px;height:32px;border-radius:50%;background:#00a884;display:flex;align-items:center;justify-content:center;font-size:14px;font-weight:bold;color:#fff;}
+.bubble{max-width:70%;padding:10px 14px;border-radius:14px;line-height:1.4;word-wrap:break-word;box-shadow:0 2px 4px rgba(0,0,0,0.3);background:rgba(255,255,255,0.1);}
+.me .bubble{background:#00a884;color:#fff;border-bottom-right-radius:4px;}
+.other .bubble{border-bottom-left-radius:4px;}
+.meta{font-size:11px;opacity:0.7;margin-top:4px;}
+.system-msg{text-align:center;color:#aaa;font-style:italic;margin:5px 0;}
+.emoji-msg{font-size:2em;text-align:center;padding:10px;}
+.sticker-msg{text-align:center;padding:5px;}
+form{display:flex;padding:10px;background:rgba(0,0,0,0.3);gap:8px;position:sticky;bottom:0;backdrop-filter:blur(4px);}
+input,button{padding:10px;border:none;border-radius:8px;font-size:15px;}
+input[name=text]{flex:1;}
+button{background:#00a884;color:#fff;cursor:pointer;}
+.controls{display:flex;gap:5px;}
+#online{font-size:13px;font-weight:normal;opacity:.8;cursor:default;}
+.icon-btn{background:none;border:none;color:#fff;font-size:18px;cursor:pointer;padding:5px;}
+.picker{position:absolute;bottom:60px;background:rgba(0,0,0,0.9);border-radius:10px;padding:10px;max-width:300px;max-height:200px;overflow-y:auto;display:none;flex-wrap:wrap;gap:5px;backdrop-filter:blur(10px);z-index:1000;}
+.emoji{font-size:24px;cursor:pointer;padding:5px;transition:transform 0.2s;}
+.emoji:hover{transform:scale(1.2);}
+.sticker{padding:8px 12px;background:linear-gradient(135deg,#667eea,#764ba2);border-radius:15px;cursor:pointer;color:white;font-weight:bold;text-align:center;min-width:80px;transition:transform 0.2s;}
+.sticker:hover{transform:scale(1.05);}
+.recorder{display:none;position:fixed;top:50%;left:50%;transform:translate(-50%,-50%);background:rgba(0,0,0,0.9);padding:20px;border-radius:10px;z-index:1000;}
+.call-ui{position:fixed;top:10px;right:10px;background:rgba(0,0,0,0.8);padding:10px;border-radius:10px;z-index:999;}
+@keyframes fadeIn{from{opacity:0;transform:translateY(5px);}to{opacity:1;transform:translateY(0);}}
+.typing{font-style:italic;color:#aaa;font-size:12px;padding:5px 10px;}
+.recording-animation{animation:pulse 1s infinite;}
+@keyframes pulse{0%{opacity:1;}50%{opacity:0.5;}100%{opacity:1;}}
+"""
 
-<script>
-let log=document.getElementById('log'),uname='',seenWelcome=false,emojis={{}},stickers={{}};
+PAGE_JS = """let log=document.getElementById('log'),uname='',seenWelcome=false,emojis={},stickers={};
+// The room comes from ?room= on the page URL; every request below is scoped to it
+const room=new URLSearchParams(location.search).get('room')||'main', rq='room='+encodeURIComponent(room);
+if(room!=='main'){document.getElementById('title').textContent+=' #'+room; document.title+=' #'+room;}
 let mediaRecorder, audioChunks = [], isRecording = false, currentCall = null;
 let typingTimer, isTyping = false;
 
-function avatarLetter(name){{return name?name.trim()[0].toUpperCase():"?";}}
-function escapeHtml(s){{return s.replace(/[&<>"']/g,c=>({{'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}})[c]);}}
+function avatarLetter(name){return name?name.trim()[0].toUpperCase():"?";}
+function escapeHtml(s){return s.replace(/[&<>"']/g,c=>({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'})[c]);}
 
-function add(m){{
+function add(m, into=log){
     if(m.user==="system" && seenWelcome && m.type==="system") return; 
     if(m.user==="system") seenWelcome=true;
     
     let mine=(m.user===uname);
     
-    if(m.type === "system") {{
+    if(m.type === "system") {
         let wrap=document.createElement('div');
         wrap.className='system-msg';
         wrap.textContent = m.text;
-        log.appendChild(wrap);
-    }} else if(m.type === "emoji") {{
+        into.appendChild(wrap);
+    } else if(m.type === "emoji") {
         let wrap=document.createElement('div');
         wrap.className='msg-wrap '+(mine?'me':'other');
         let av=document.createElement('div');av.className='avatar';av.textContent=avatarLetter(m.user);
         let bubble=document.createElement('div');bubble.className='bubble emoji-msg';
         bubble.innerHTML='<b>'+escapeHtml(m.user)+'</b><div style="font-size:2em;">'+m.text+'</div><div class="meta">'+new Date(m.ts).toLocaleTimeString()+'</div>';
-        wrap.appendChild(av);wrap.appendChild(bubble);log.appendChild(wrap);
-    }} else if(m.type === "sticker") {{
+        wrap.appendChild(av);wrap.appendChild(bubble);into.appendChild(wrap);
+    } else if(m.type === "sticker") {
         let wrap=document.createElement('div');
         wrap.className='msg-wrap '+(mine?'me':'other');
         let av=document.createElement('div');av.className='avatar';av.textContent=avatarLetter(m.user);
         let bubble=document.createElement('div');bubble.className='bubble sticker-msg';
         bubble.innerHTML='<b>'+escapeHtml(m.user)+'</b>'+m.text+'<div class="meta">'+new Date(m.ts).toLocaleTimeString()+'</div>';
-        wrap.appendChild(av);wrap.appendChild(bubble);log.appendChild(wrap);
-    }} else {{
+        wrap.appendChild(av);wrap.appendChild(bubble);into.appendChild(wrap);
+    } else {
         let wrap=document.createElement('div');
         wrap.className='msg-wrap '+(mine?'me':'other');
         let av=document.createElement('div');av.className='avatar';av.textContent=avatarLetter(m.user);
         let bubble=document.createElement('div');bubble.className='bubble';
         bubble.innerHTML='<b>'+escapeHtml(m.user)+'</b><br>'+m.text+'<div class="meta">'+new Date(m.ts).toLocaleTimeString()+'</div>';
-        wrap.appendChild(av);wrap.appendChild(bubble);log.appendChild(wrap);
-    }}
-    log.scrollTop=log.scrollHeight;
-}}
+        wrap.appendChild(av);wrap.appendChild(bubble);into.appendChild(wrap);
+    }
+    if(into===log) log.scrollTop=log.scrollHeight;
+}
+
+// Load history, then live updates over a WebSocket (SSE if one can't be opened).
+// Either way the stream resumes after the last message shown
+let es, ws, lastSeq=0, oldestSeq=0, loadingOlder=false;
+function show(m){
+    if(m.type==='resync') return resync();
+    if(m.type==='presence') return presence(m);
+    if(m.type==='typing') return typing(m);
+    lastSeq=m.seq; add(m);
+}
+// Streams carry the name, so the room knows who is online
+function me(){return document.querySelector('input[name="username"]').value||localStorage.getItem('chatUsername')||'';}
+function connect(){
+    if(!window.WebSocket) return fallback();
+    let opened=false;
+    ws=new WebSocket((location.protocol==='https:'?'wss://':'ws://')+location.host+'/ws?'+rq+'&after='+lastSeq+'&user='+encodeURIComponent(me()));
+    ws.onopen=()=>{opened=true;};
+    ws.onmessage=e=>{try{show(JSON.parse(e.data));}catch{}};
+    // like /stream's retry: hint, a random 1-10s so a restart doesn't bring every tab back at once
+    ws.onclose=()=>{ws=null; opened?setTimeout(connect,1000+Math.random()*9000):fallback();};
+}
+function fallback(){
+    es=new EventSource('/stream?'+rq+'&after='+lastSeq+'&user='+encodeURIComponent(me()));
+    es.onmessage=e=>{try{show(JSON.parse(e.data));}catch{}};
+    es.addEventListener('resync', resync);
+    es.addEventListener('presence', e=>presence(JSON.parse(e.data)));
+    es.addEventListener('typing', e=>typing(JSON.parse(e.data)));
+}
+function load(){
+    fetch('/history?'+rq).then(r=>r.json()).then(d=>{
+        d.forEach(m=>add(m));
+        if(d.length){oldestSeq=d[0].seq; lastSeq=d[d.length-1].seq;}
+        connect();
+    });
+}
+// The server dropped messages this tab was too slow to take: start over from /history
+function disconnect(){
+    if(es) es.close();
+    if(ws){ws.onclose=null; ws.close();}
+    es=ws=null;
+}
+function resync(){disconnect(); log.innerHTML=''; seenWelcome=false; load();}
+load();
+
+// Who is online and the room's calls: a full state when the stream opens, then deltas
+let online=new Set(), calls={};
+function presence(p){
+    if(p.op==='state'){online=new Set(p.users); calls={}; p.calls.forEach(c=>calls[c.callId]=c);}
+    else if(p.op==='join') online.add(p.user);
+    else if(p.op==='leave') online.delete(p.user);
+    else if(p.op==='call') calls[p.call.callId]=p.call;
+    else if(p.op==='call-end') delete calls[p.callId];
+    let n=Object.keys(calls).length, el=document.getElementById('online');
+    el.textContent='🟢 '+online.size+' online'+(n?' · 📞 '+n:'');
+    el.title=[...online].join(', ');
+}
+// Typing indicator: while typing, tell the room at most every 2s. The server
+// collapses these into one list per room and drops anyone quiet for a few seconds
+document.getElementById('textInput').addEventListener('input', ()=>{
+    let name=me();
+    if(!name || isTyping) return;
+    isTyping=true; action('typing', {username:name});
+    clearTimeout(typingTimer); typingTimer=setTimeout(()=>{isTyping=false;}, 2000);
+});
+function typing(t){
+    let names=t.users.filter(u=>u!==me()), n=names.length+t.more, el=document.getElementById('typing');
+    if(!n){el.textContent=''; return;}
+    el.textContent=names.join(', ')+(t.more?(names.length?' and ':'')+t.more+' more':'')+(n>1?' are':' is')+' typing…';
+}
+// A new name reconnects the stream under it
+document.querySelector('input[name="username"]').addEventListener('change', ()=>{if(es||ws){disconnect(); connect();}});
 
-// Load history and setup SSE
-fetch('/history').then(r=>r.json()).then(d=>d.forEach(add));
-let es=new EventSource('/stream');
-es.onmessage=e=>{{try{{add(JSON.parse(e.data));}}catch{{}}}};
+// Actions go over the open WebSocket, else as a POST
+function action(op, body){
+    if(ws && ws.readyState===WebSocket.OPEN){ws.send(JSON.stringify({op, ...body})); return Promise.resolve();}
+    return fetch('/'+op+'?'+rq, {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(body)});
+}
+
+// Older pages are fetched when scrolling to the top, keeping the view where it was
+log.addEventListener('scroll', ()=>{
+    if(log.scrollTop>40 || loadingOlder || oldestSeq<=1) return;
+    loadingOlder=true;
+    fetch('/history?'+rq+'&before='+oldestSeq).then(r=>r.json()).then(d=>{
+        if(!d.length){oldestSeq=0; return;}
+        let frag=document.createDocumentFragment(), h=log.scrollHeight;
+        d.forEach(m=>add(m, frag));
+        log.insertBefore(frag, log.firstChild);
+        log.scrollTop+=log.scrollHeight-h;
+        oldestSeq=d[0].seq;
+    }).finally(()=>{loadingOlder=false;});
+});
 
 // Load emojis and stickers
-fetch('/emojis').then(r=>r.json()).then(data=>{{emojis=data; loadEmojis();}});
-fetch('/stickers').then(r=>r.json()).then(data=>{{stickers=data; loadStickers();}});
+fetch('/emojis').then(r=>r.json()).then(data=>{emojis=data; loadEmojis();});
+fetch('/stickers').then(r=>r.json()).then(data=>{stickers=data; loadStickers();});
 
-function loadEmojis(){{
+function loadEmojis(){
     let picker = document.getElementById('emojiPicker');
     picker.innerHTML = '';
-    for(let [name, emoji] of Object.entries(emojis)){{
+    for(let [name, emoji] of Object.entries(emojis)){
         let emojiEl = document.createElement('div');
         emojiEl.className = 'emoji';
         emojiEl.textContent = emoji;
         emojiEl.title = name;
-        emojiEl.onclick = () => {{
+        emojiEl.onclick = () => {
             sendEmoji(emoji);
             picker.style.display = 'none';
-        }};
+        };
         picker.appendChild(emojiEl);
-    }}
-}}
+    }
+}
 
-function loadStickers(){{
+function loadStickers(){
     let picker = document.getElementById('stickerPicker');
     picker.innerHTML = '';
-    for(let [name, sticker] of Object.entries(stickers)){{
+    for(let [name, sticker] of Object.entries(stickers)){
         let stickerEl = document.createElement('div');
         stickerEl.className = 'sticker';
         stickerEl.textContent = sticker;
         stickerEl.title = name;
-        stickerEl.onclick = () => {{
+        stickerEl.onclick = () => {
             sendSticker(sticker);
             picker.style.display = 'none';
-        }};
+        };
         picker.appendChild(stickerEl);
-    }}
-}}
+    }
+}
 
-function toggleEmojiPicker(){{
+function toggleEmojiPicker(){
     let picker = document.getElementById('emojiPicker');
     let stickerPicker = document.getElementById('stickerPicker');
     picker.style.display = picker.style.display === 'flex' ? 'none' : 'flex';
     stickerPicker.style.display = 'none';
-}}
+}
 
-function toggleStickerPicker(){{
+function toggleStickerPicker(){
     let picker = document.getElementById('stickerPicker');
     let emojiPicker = document.getElementById('emojiPicker');
     picker.style.display = picker.style.display === 'flex' ? 'none' : 'flex';
     emojiPicker.style.display = 'none';
-}}
+}
 
-function sendEmoji(emoji){{
-    fetch('/send-emoji', {{
-        method: 'POST',
-        headers: {{'Content-Type': 'application/json'}},
-        body: JSON.stringify({{
-            username: uname,
-            emoji: emoji
-        }})
-    }});
-}}
-
-function sendSticker(sticker){{
-    fetch('/send-sticker', {{
-        method: 'POST',
-        headers: {{'Content-Type': 'application/json'}},
-        body: JSON.stringify({{
-            username: uname,
-            sticker: sticker
-        }})
-    }});
-}}
+function sendEmoji(emoji){
+    action('send-emoji', {
+        username: uname,
+        emoji: emoji
+    });
+}
+
+function sendSticker(sticker){
+    action('send-sticker', {
+        username: uname,
+        sticker: sticker
+    });
+}
 
 // Voice recording - SIMPLIFIED VERSION
-async function toggleRecording(){{
-    if(!isRecording){{
-        try{{
-            let stream = await navigator.mediaDevices.getUserMedia({{audio:true}});
+async function toggleRecording(){
+    if(!isRecording){
+        try{
+            let stream = await navigator.mediaDevices.getUserMedia({audio:true});
             mediaRecorder = new MediaRecorder(stream);
             audioChunks = [];
             
-            mediaRecorder.ondataavailable = e=>{{
+            mediaRecorder.ondataavailable = e=>{
                 audioChunks.push(e.data);
-            }};
+            };
             
-            mediaRecorder.onstop = ()=>{{
-                let audioBlob = new Blob(audioChunks, {{type:'audio/webm'}});
+            mediaRecorder.onstop = ()=>{
+                let audioBlob = new Blob(audioChunks, {type:'audio/webm'});
                 // Create a simple audio file upload
                 let formData = new FormData();
                 formData.append('username', uname);
                 formData.append('file', audioBlob, 'voice_message.webm');
                 
-                fetch('/upload', {{
+                fetch('/upload?'+rq, {
                     method: 'POST',
                     body: formData
-                }}).then(()=>{{
+                }).then(()=>{
                     console.log('Voice message sent');
-                }});
-            }};
+                });
+            };
             
             mediaRecorder.start();
             isRecording = true;
             document.getElementById('recorder').style.display = 'block';
             document.getElementById('recordBtn').textContent = '⏹️';
             document.getElementById('recordBtn').style.background = '#ff4444';
-        }}catch(e){{
+        }catch(e){
             alert('Microphone access denied or not available');
             console.error('Recording error:', e);
-        }}
-    }}else{{
+        }
+    }else{
         stopRecording();
-    }}
-}}
+    }
+}
 
-function stopRecording(){{
-    if(mediaRecorder && isRecording){{
+function stopRecording(){
+    if(mediaRecorder && isRecording){
         mediaRecorder.stop();
         mediaRecorder.stream.getTracks().forEach(track=>track.stop());
         isRecording = false;
         document.getElementById('recorder').style.display = 'none';
         document.getElementById('recordBtn').textContent = '🎤';
         document.getElementById('recordBtn').style.background = '';
-    }}
-}}
+    }
+}
 
-function cancelRecording(){{
-    if(mediaRecorder && isRecording){{
+function cancelRecording(){
+    if(mediaRecorder && isRecording){
         mediaRecorder.stop();
         mediaRecorder.stream.getTracks().forEach(track=>track.stop());
         isRecording = false;
@@ -659,119 +1835,954 @@ function cancelRecording(){{
         document.getElementById('recordBtn').textContent = '🎤';
         document.getElementById('recordBtn').style.background = '';
         audioChunks = [];
-    }}
-}}
+    }
+}
 
 // Call functionality
-function toggleVoiceCall(){{
-    if(!currentCall){{
+function toggleVoiceCall(){
+    if(!currentCall){
         startCall('voice');
-    }}else{{
+    }else{
         endCall();
-    }}
-}}
+    }
+}
 
-function toggleVideoCall(){{
-    if(!currentCall){{
+function toggleVideoCall(){
+    if(!currentCall){
         startCall('video');
-    }}else{{
+    }else{
         endCall();
-    }}
-}}
+    }
+}
 
-function startCall(type){{
+function startCall(type){
     let callId = 'call_' + Date.now();
     currentCall = callId;
     
-    fetch('/start-call', {{
-        method: 'POST',
-        headers: {{'Content-Type': 'application/json'}},
-        body: JSON.stringify({{
-            username: uname,
-            callId: callId,
-            callType: type
-        }})
-    }});
+    action('start-call', {
+        username: uname,
+        callId: callId,
+        callType: type
+    });
     
     document.getElementById('callUI').style.display = 'block';
-    document.getElementById('callInfo').innerHTML = `${{type==='voice'?'📞':'🎥'}} ${{uname}}'s ${{type}} call`;
-}}
-
-function endCall(){{
-    if(currentCall){{
-        fetch('/end-call', {{
-            method: 'POST',
-            headers: {{'Content-Type': 'application/json'}},
-            body: JSON.stringify({{
-                username: uname,
-                callId: currentCall
-            }})
-        }});
+    document.getElementById('callInfo').innerHTML = `${type==='voice'?'📞':'🎥'} ${uname}'s ${type} call`;
+}
+
+function endCall(){
+    if(currentCall){
+        action('end-call', {
+            username: uname,
+            callId: currentCall
+        });
         currentCall = null;
         document.getElementById('callUI').style.display = 'none';
-    }}
-}}
+    }
+}
 
 // Form submission
-document.getElementById('f').onsubmit=async e=>{{
-  e.preventDefault();uname=f.username.value;
+document.getElementById('f').onsubmit=async e=>{
+  e.preventDefault();uname=f.username.value;isTyping=false;clearTimeout(typingTimer);
   
-  if(f.file.files.length>0){{
+  if(f.file.files.length>0){
       let fd=new FormData(f);
-      await fetch('/upload',{{method:'POST',body:fd}});
-  }}
-  else if(f.text.value.trim()!==''){{
+      await fetch('/upload?'+rq,{method:'POST',body:fd});
+  }
+  else if(f.text.value.trim()!=='' && ws && ws.readyState===WebSocket.OPEN){
+      ws.send(JSON.stringify({op:'send', username:uname, text:f.text.value}));
+  }
+  else if(f.text.value.trim()!==''){
       let fd=new URLSearchParams();
       fd.append('username', uname);
       fd.append('text', f.text.value);
-      await fetch('/send',{{method:'POST',headers:{{'Content-Type':'application/x-www-form-urlencoded'}},body:fd}});
-  }}
+      await fetch('/send?'+rq,{method:'POST',headers:{'Content-Type':'application/x-www-form-urlencoded'},body:fd});
+  }
   f.text.value='';f.file.value='';
-}};
+};
 
 // Close pickers when clicking outside
-document.addEventListener('click', (e)=>{{
-    if(!e.target.closest('.picker') && !e.target.closest('.icon-btn')){{
+document.addEventListener('click', (e)=>{
+    if(!e.target.closest('.picker') && !e.target.closest('.icon-btn')){
         document.getElementById('emojiPicker').style.display = 'none';
         document.getElementById('stickerPicker').style.display = 'none';
-    }}
-}});
+    }
+});
 
 // Initialize with default username if available
-window.addEventListener('load', ()=>{{
+window.addEventListener('load', ()=>{
     let savedName = localStorage.getItem('chatUsername');
-    if(savedName){{
+    if(savedName){
         document.querySelector('input[name="username"]').value = savedName;
-    }}
-}});
+    }
+});
 
 // Save username when typing
-document.querySelector('input[name="username"]').addEventListener('input', (e)=>{{
+document.querySelector('input[name="username"]').addEventListener('input', (e)=>{
     localStorage.setItem('chatUsername', e.target.value);
-}});
-</script>
-""".encode())
+});
+"""
+
+PAGE_HTML = """<!doctype html>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>NewGen Tech Chat</title>
+<link rel="stylesheet" href="{css_url}">
+<header>
+    <span id="title">💬 NewGen Tech Chat</span>
+    <span id="online"></span>
+    <div class="controls">
+        <button class="icon-btn" onclick="toggleEmojiPicker()">😀</button>
+        <button class="icon-btn" onclick="toggleStickerPicker()">🖼️</button>
+        <button class="icon-btn" onclick="toggleVoiceCall()">📞</button>
+        <button class="icon-btn" onclick="toggleVideoCall()">🎥</button>
+    </div>
+</header>
+<div id="log"></div>
+<div id="typing" class="typing"></div>
+<form id="f" enctype="multipart/form-data">
+<input name="username" placeholder="Name" required style="max-width:120px">
+<input name="text" placeholder="Type a message..." autocomplete="off" id="textInput">
+<input type="file" name="file" accept="*/*" id="fileInput" style="display:none">
+<button type="button" onclick="document.getElementById('fileInput').click()">📎</button>
+<button type="button" id="recordBtn" onclick="toggleRecording()">🎤</button>
+<button type="submit">Send</button>
+</form>
+
+<div id="emojiPicker" class="picker"></div>
+<div id="stickerPicker" class="picker"></div>
+<div id="recorder" class="recorder">
+    <h3>🎤 Recording...</h3>
+    <div style="display:flex;align-items:center;gap:10px;margin:10px 0;">
+        <div id="recordingIndicator" style="width:20px;height:20px;background:red;border-radius:50%;animation:pulse 1s infinite;"></div>
+        <span>Recording in progress</span>
+    </div>
+    <button onclick="stopRecording()" style="background:#00a884;">Stop & Send</button>
+    <button onclick="cancelRecording()" style="background:#666;">Cancel</button>
+</div>
+
+<div id="callUI" class="call-ui" style="display:none">
+    <div id="callInfo"></div>
+    <button onclick="endCall()">End Call</button>
+</div>
+
+<script src="{js_url}"></script>
+"""
+
+class StaticAsset:
+    # Response bytes built once, with precompressed variants and one strong ETag per encoding.
+    def __init__(self, body, ctype, cache):
+        self.ctype = ctype; self.cache = cache; digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {"identity": (body, f'"{digest}"'), "gzip": (gzip.compress(body, 9), f'"{digest}-gz"')}
+        if brotli: self.variants["br"] = (brotli.compress(body), f'"{digest}-br"')
+        self.digest = digest
+
+    def choose(self, accept_encoding):
+        # Best encoding the client accepts; q=0 entries count as refused.
+        accepted = set()
+        for item in (accept_encoding or "").split(","):
+            coding, _, q = item.partition(";"); q = q.strip().replace(" ","")
+            try: weight = float(q[2:]) if q.startswith("q=") else 1.0
+            except ValueError: weight = 1.0
+            if weight > 0: accepted.add(coding.strip().lower())
+        for coding in ("br", "gzip"):
+            if coding in self.variants and (coding in accepted or "*" in accepted): return coding
+        return "identity"
+
+def build_assets():
+    css = StaticAsset(PAGE_CSS.encode(), "text/css; charset=utf-8", IMMUTABLE_CACHE)
+    js = StaticAsset(PAGE_JS.encode(), "application/javascript; charset=utf-8", IMMUTABLE_CACHE)
+    css_url = f"/static/app.{css.digest}.css"; js_url = f"/static/app.{js.digest}.js"
+    html = PAGE_HTML.format(css_url=css_url, js_url=js_url).encode()
+    return {"/": StaticAsset(html, "text/html; charset=utf-8", "no-cache"), css_url: css, js_url: js}
+
+assets = build_assets()
+
+class AssetCatalog:
+    # Emoji/sticker picker data: the directory is read once and kept as a prebuilt
+    # JSON response, and is only re-scanned when the directory's mtime changes.
+    def __init__(self, directory):
+        self.directory = directory; self.lock = threading.Lock(); self.mtime = None; self._asset = None
+    def asset(self):
+        try: mtime = os.stat(self.directory).st_mtime_ns
+        except OSError: mtime = None
+        with self.lock:
+            if self._asset is None or mtime != self.mtime:
+                self._asset = StaticAsset(json.dumps(self.scan()).encode(), "application/json", "no-cache")
+                self.mtime = mtime
+            return self._asset
+    def scan(self):
+        items = {}
+        try: names = sorted(os.listdir(self.directory))
+        except OSError: return items
+        for f in names:
+            if f.endswith('.txt'):
+                try:
+                    with open(os.path.join(self.directory, f), 'r', encoding="utf-8") as ef:
+                        items[f[:-4]] = ef.read().strip()
+                except OSError:
+                    continue
+        return items
+
+emoji_catalog = AssetCatalog(EMOJI_DIR)
+sticker_catalog = AssetCatalog(STICKER_DIR)
+
+# Chat actions shared by the POST endpoints and /ws. Each validates data,
+# publishes into room and returns the JSON reply, or None for a bad request.
+def display_name(data): return str(data.get("username") or "Anon")[:30].strip() or "Anon"
+
+def send_text(room, data):
+    user = display_name(data)
+    text = str(data.get("text") or "").strip()
+    if not text: return None
+    room.publish({"user":user,"text":text,"ts":now_ms(),"type":"text"})
+    return {"status":"sent"}
+
+def send_typing(room, data):
+    typists.typing(room, display_name(data))
+    return {"status":"ok"}
+
+def send_emoji(room, data):
+    user = display_name(data)
+    emoji = data.get("emoji", "")
+    if not emoji: return None
+    room.publish({"user":user,"text":emoji,"ts":now_ms(),"type":"emoji"})
+    return {"status":"sent"}
+
+def send_sticker(room, data):
+    user = display_name(data)
+    sticker = data.get("sticker", "")
+    if not sticker: return None
+    # Format sticker as a nice message
+    sticker_msg = f"""
+        <div style="background:linear-gradient(135deg,#667eea,#764ba2);padding:15px;border-radius:20px;text-align:center;color:white;font-weight:bold;font-size:18px;max-width:200px;margin:5px 0;">
+            {sticker}
+        </div>
+        """
+    room.publish({"user":user,"text":sticker_msg,"ts":now_ms(),"type":"sticker"})
+    return {"status":"sent"}
+
+def start_call(room, data):
+    user = display_name(data)
+    call = {"callId": str(data.get("callId") or int(time.time())), "users": [user], "start_time": now_ms(), "type": str(data.get("callType", "voice"))}
+    presence.start_call(room, call)
+    call_id = call["callId"]
+    
+    # Notify all users about the call
+    msg = {
+        "user": "system", 
+        "text": f"📞 {user} started a {call['type']} call",
+        "ts": now_ms(),
+        "type": "system",
+        "callId": call_id
+    }
+    room.publish(msg)
+    return {"callId": call_id, "status": "started"}
+
+def end_call(room, data):
+    presence.end_call(room, str(data.get("callId")))   # notifies all users about the call end
+    return {"status": "ended"}
+
+def call_ended(call):
+    duration = (now_ms() - call["start_time"]) // 1000
+    return {
+        "user": "system", 
+        "text": f"📞 Call ended (duration: {duration}s)",
+        "ts": now_ms(),
+        "type": "system"
+    }
+
+ACTIONS = {"send": send_text, "send-emoji": send_emoji, "send-sticker": send_sticker,
+           "start-call": start_call, "end-call": end_call, "typing": send_typing}
+
+RATE_CLASS = {"send": "send", "send-emoji": "send", "send-sticker": "send", "start-call": "call", "end-call": "call",
+              "send-batch": "batch", "upload": "upload", "typing": "typing"}
+
+class RateLimiter:
+    # Token buckets for the POST routes (see RATE_LIMITS): a request takes a token
+    # (a batch one per message) from its address's bucket and its username's. A
+    # bucket is stored as the time it will be full again (GCRA), one float, in one of
+    # SHARDS dicts with a lock each, so concurrent requests rarely meet. A shard past
+    # SHARD_KEYS forgets full buckets.
+    SHARDS = 16
+    SHARD_KEYS = 4096
+    def __init__(self): self.shards = [({}, threading.Lock()) for _ in range(self.SHARDS)]
+
+    def take(self, cls, ip, user=None, cost=1):
+        # 0 when allowed, else seconds until the request would be.
+        if cls not in RATE_LIMITS: return 0
+        rate, burst = RATE_LIMITS[cls]
+        for kind, who, share in (("ip", ip, RATE_IP_SHARE), ("user", user, 1)):
+            if who is None: continue
+            wait = self.bucket((cls, kind, who), rate * share, burst * share, cost)
+            if wait: metrics.inc("chat_rate_limited_total", (("class", cls), ("key", kind))); return wait
+        return 0
+
+    def bucket(self, key, rate, burst, cost=1):
+        now = time.monotonic(); full, lock = self.shards[hash(key) % self.SHARDS]
+        with lock:
+            tat = max(full.get(key, now), now)   # tokens left: burst - (tat - now) * rate
+            wait = tat - now - (burst - cost) / rate
+            if wait > 0: return wait
+            full[key] = tat + cost / rate
+            if len(full) > self.SHARD_KEYS:
+                for k in [k for k, t in full.items() if t <= now]: del full[k]
+        return 0
+
+limiter = RateLimiter()
+upload_slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+
+ROUTES = {"/", "/stream", "/ws", "/history", "/emojis", "/stickers", "/search", "/call-status", "/streams", "/metrics",
+          "/upload", "/send-batch"} | {"/" + a for a in ACTIONS}
+
+def route_label(path):
+    # Metric label for a request path; file and unknown paths collapse so the label set stays small.
+    if path in ROUTES: return path
+    if path in assets: return "/static/*"
+    for prefix in ("/uploads/", "/" + STICKER_DIR + "/"):
+        if path.startswith(prefix): return prefix + "*"
+    return "other"
+
+access_log = None   # buffered binary file for request lines (--access-log), or None
+
+def open_access_log(path):
+    f = open(sys.stdout.fileno() if path == "-" else path, "ab", buffering=ACCESS_LOG_BUFFER, closefd=path != "-")
+    def flusher():
+        while True:
+            time.sleep(1)
+            try: f.flush()
+            except (OSError, ValueError): return
+    threading.Thread(target=flusher, name="access-log", daemon=True).start()
+    return f
+
+class ChatHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests, so every response that
+    # has a body must say how long it is (_reply does); /stream closes instead.
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def _set_headers(self,status=200,extra=None,ctype="text/html; charset=utf-8"):
+        self.send_response(status); self.send_header("Content-Type",ctype)
+        if not extra or "Cache-Control" not in extra: self.send_header("Cache-Control","no-store, no-cache, must-revalidate")
+        if extra: [self.send_header(k,v) for k,v in extra.items()]
+        if self.close_connection and not (extra and "Connection" in extra): self.send_header("Connection","close")
+        self.end_headers()
+    def _reply(self,status,body=b"",ctype="text/plain",extra=None):
+        if status not in (204,304): extra = dict(extra or {}, **{"Content-Length":str(len(body))})
+        self._set_headers(status,ctype=ctype,extra=extra)
+        if body: self.wfile.write(body); metrics.inc("http_response_bytes_total", n=len(body))
+    def send_response(self,code,message=None): self.status = code; super().send_response(code,message)
+    def log_message(self,fmt,*a):
+        if access_log: access_log.write(("[%s] %s\n"%(self.address_string(),fmt%a)).encode())
+    def log_error(self,fmt,*a): sys.stderr.write("[%s] %s\n"%(self.address_string(),fmt%a))
+
+    def room(self, name=None):
+        # The room named by ?room= (or a room form field); 400 and None if it can't be used.
+        room = get_room(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get("room",[name])[0])
+        if room is None: self._reply(400, b"Bad room")
+        return room
+
+    def do_GET(self): self.timed(self.route_get)
+    def do_POST(self): self.timed(self.route_post)
+
+    def timed(self, route):
+        # Runs one request's route and records its status and latency.
+        p = urllib.parse.urlparse(self.path); self.status = None; t0 = time.perf_counter()
+        try: route(p)
+        except BusUnavailable: self._reply(503, b"Message bus unavailable")
+        finally: metrics.request(self.command, p.path, self.status, time.perf_counter() - t0)
+
+    def route_get(self, p):
+        if p.path == "/": return self.page()
+        if p.path in assets: return self.send_asset(assets[p.path])
+        if p.path == "/stream": return self.sse()
+        if p.path == "/ws": return self.websocket()
+        if p.path == "/history":
+            return self.get_history(urllib.parse.parse_qs(p.query))
+        elif p.path == "/emojis":
+            return self.send_asset(emoji_catalog.asset())
+        elif p.path == "/stickers":
+            return self.send_asset(sticker_catalog.asset())
+        elif m := UPLOAD_URL.fullmatch(p.path):
+            # Content-addressed: the hash is the ETag and browsers may keep it forever
+            return self.serve_file(UPLOAD_DIR, upload_store.blob(m.group(1)), IMMUTABLE_CACHE,
+                                   ctype=mimetypes.guess_type(urllib.parse.unquote(m.group(2)))[0], etag='"%s"' % m.group(1))
+        elif p.path.startswith("/uploads/") and LEGACY_UPLOAD.fullmatch(urllib.parse.unquote(p.path[len("/uploads/"):])):
+            # Uploads from before the blob store, still linked from old messages
+            return self.serve_file(UPLOAD_DIR, p.path[len("/uploads/"):], IMMUTABLE_CACHE)
+        elif p.path.startswith("/" + STICKER_DIR + "/"):
+            return self.serve_file(STICKER_DIR, p.path[len(STICKER_DIR)+2:])
+        elif p.path == "/search":
+            return self.get_search(urllib.parse.parse_qs(p.query))
+        elif p.path == "/call-status":
+            return self.get_call_status()
+        elif p.path == "/streams":
+            self._reply(200, json.dumps([st.stats() for st in list(streams)]).encode(), "application/json")
+        elif p.path == "/metrics":
+            self._reply(200, metrics.render(stream_gauges()), "text/plain; version=0.0.4")
+        else:
+            self._reply(404, b"Not found")
+
+    def route_post(self, p):
+        path = p.path
+        if path == "/send": return self.handle_text()
+        if path == "/upload": return self.handle_upload()
+        if path[1:] in ACTIONS: return self.handle_action(path[1:])
+        if path == "/send-batch": return self.handle_batch()
+        self.close_connection = True   # the body was not read
+        self._reply(404, b"Not found")
+
+    def handle_text(self):
+        ln = int(self.headers.get("Content-Length",0)); data = urllib.parse.parse_qs(self.rfile.read(ln).decode())
+        data = {k: v[0] for k, v in data.items()}
+        room = self.room(data.get("room"))
+        if not room or self.limited("send", display_name(data)): return
+        if send_text(room, data) is None: self._reply(400); return
+        self._reply(204)
+
+    def handle_action(self, name):
+        ln = int(self.headers.get("Content-Length",0)); data = json.loads(self.rfile.read(ln).decode())
+        room = self.room(data.get("room"))
+        if not room or self.limited(RATE_CLASS[name], display_name(data)): return
+        reply = ACTIONS[name](room, data)
+        if reply is None: self._reply(400); return
+        self._reply(200, json.dumps(reply).encode(), "application/json")
+
+    def handle_batch(self):
+        # For bots and bridges: {"username": "bot", "messages": [{"text": "hi"}, {"username": "x", "text": "yo", "type": "emoji"}]}
+        # (room from ?room= or a "room" key). All messages are appended under one acquisition of the room's lock.
+        ln = int(self.headers.get("Content-Length",0))
+        try:
+            data = json.loads(self.rfile.read(ln).decode()); items = data["messages"]
+            if not isinstance(items, list) or len(items) > SEND_BATCH_MAX: raise ValueError
+        except (ValueError, KeyError, TypeError): self._reply(400, b"Bad batch"); return
+        room = self.room(data.get("room"))
+        if not room: return
+        msgs = []; ts = now_ms()
+        for it in items:
+            if not isinstance(it, dict): continue
+            user = str(it.get("username") or data.get("username") or "Anon")[:30].strip() or "Anon"
+            text = str(it.get("text","")).strip()
+            if text: msgs.append({"user":user,"text":text,"ts":ts,"type":"emoji" if it.get("type") == "emoji" else "text"})
+        if self.limited("batch", display_name(data), cost=max(len(msgs), 1)): return
+        if msgs: room.publish_many(msgs)
+        self._reply(200, json.dumps({"status":"sent","count":len(msgs)}).encode(), "application/json")
+
+    def handle_upload(self):
+        ctype = self.headers.get("Content-Type","")
+        m = re.search(r'boundary="?([^";]+)"?', ctype)
+        if not ctype.startswith("multipart/form-data") or not m:
+            self.close_connection = True; self._reply(400); return
+        length = int(self.headers.get("Content-Length",0))
+        if length > MAX_UPLOAD_BYTES:
+            self.close_connection = True   # don't read a body we are refusing
+            self._reply(413, b"Upload too large"); return
+        # The username is in the body, so only the address is checked before reading it
+        if self.limited("upload", close=True): return
+        if not upload_slots.acquire(blocking=False):
+            self.close_connection = True
+            self._reply(503, b"Too many uploads in progress", extra={"Retry-After": "1"}); return
+        try: fields, files = MultipartParser(self.rfile, m.group(1).encode(), length).parse()
+        except (ValueError, OSError):
+            self.close_connection = True
+            self._reply(400, b"Malformed upload"); return
+        finally: upload_slots.release()
+        user = display_name(fields)
+        room = self.room(fields.get("room"))
+        if not room or self.limited("upload", user, address=False):   # the address paid before the body was read
+            for _, tmp, *_ in files: os.remove(tmp)
+            return
+
+        stored = []
+        for fname, tmp, digest, size in files:
+            metrics.observe("chat_upload_size_bytes", size, buckets=Metrics.SIZE)
+            fname = os.path.basename(fname.replace("\\","/")).replace(" ","_") or "file"
+            upload_store.put(tmp, digest); stored.append((fname, digest, size))
+        media_pool.submit(publish_uploads, room, user, stored)   # the client is done once the bytes are on disk
+        self._reply(204)
+
+    def limited(self, cls, user=None, close=False, address=True, cost=1):
+        # Replies 429 with Retry-After when this address or user is over the route class's budget.
+        wait = limiter.take(cls, self.client_address[0] if address else None, user, cost)
+        if not wait: return False
+        if close: self.close_connection = True   # the body was not read
+        self._reply(429, b"Too many requests", extra={"Retry-After": str(math.ceil(wait))})
+        return True
+
+    def get_history(self, q):
+        # ?before=<seq> / ?after=<seq> / ?limit=<n>, oldest first. Pages inside the
+        # in-memory window are sliced under the room's cond; older ones come from
+        # the journal without touching it.
+        room = self.room()
+        if not room: return
+        messages, journal = room.messages, room.journal
+        try:
+            limit = min(max(int(q.get("limit",[HISTORY_PAGE])[0]), 1), HISTORY_MAX_PAGE)
+            before = int(q["before"][0]) if "before" in q else None
+            after = int(q["after"][0]) if "after" in q else None
+        except ValueError:
+            self._reply(400, b"Bad cursor"); return
+        with room.cond:
+            if before is None and after is None and limit == HISTORY_PAGE: body = messages.latest_json()
+            else: body = None; first, head = messages.first(), messages.seq
+        if body is None:
+            if after is not None: lo = max(after+1, 1); hi = min(head, lo+limit-1)
+            else: hi = min(head, (before if before is not None else head+1) - 1); lo = max(1, hi-limit+1)
+            parts = journal.read(lo, min(hi, first-1)) if journal and lo < first else []
+            if hi >= first:
+                with room.cond: parts += [e.json for e in messages.between(lo, hi)]
+            body = b"[" + b", ".join(parts) + b"]"
+        self._reply(200, body, "application/json")
+
+    def get_search(self, q):
+        # ?q=words&user=&type=&since=&until= (ms) &before=<seq cursor>&limit=, newest first.
+        # {"results": [...], "next": cursor for the following page, or null}
+        room = self.room()
+        if not room: return
+        try:
+            limit = min(max(int(q.get("limit",[SEARCH_PAGE])[0]), 1), SEARCH_MAX_PAGE)
+            before = int(q["before"][0]) if "before" in q else 1 << 63
+            since, until = (int(q[k][0]) if k in q else None for k in ("since", "until"))
+        except ValueError:
+            self._reply(400, b"Bad search"); return
+        terms = set(search_terms(q.get("q",[""])[0]))
+        if "user" in q: terms.add("u:" + q["user"][0].lower())
+        if "type" in q: terms.add("t:" + q["type"][0])
+        idx = search.index(room)
+        if idx is None:
+            self._set_headers(503,extra={"Retry-After":"5","Content-Length":"0"}); return   # still indexing the journal
+        seqs = idx.query(terms, since, until, before, limit)
+        found = {}
+        if seqs:
+            with room.cond: found = {e.seq: e.json for e in room.messages.between(seqs[-1], seqs[0])}   # in-memory window only
+        parts = []
+        for s in seqs:
+            if s in found: parts.append(found[s])
+            elif room.journal: parts += room.journal.read(s, s)   # gone when its segment was dropped
+        nxt = str(seqs[-1]).encode() if len(seqs) == limit else b"null"
+        self._reply(200, b'{"results": [' + b", ".join(parts) + b'], "next": ' + nxt + b"}", "application/json")
+
+    def get_call_status(self):
+        room = self.room()
+        if room: self._reply(200, json.dumps(presence.calls(room)).encode(), "application/json")
+
+    def serve_file(self, root, name, cache="no-cache", ctype=None, etag=None):
+        # Conditional GET (ETag / Last-Modified), single-range requests and
+        # sendfile(2) transfer via socket.sendfile (it falls back to send() where unavailable).
+        # ctype/etag override the ones derived from the file (blobs have no extension).
+        base = os.path.realpath(root); fpath = os.path.realpath(os.path.join(base, urllib.parse.unquote(name)))
+        if os.path.commonpath([base, fpath]) != base or not os.path.isfile(fpath):
+            self._reply(404, b"Not found"); return
+        st = os.stat(fpath); size = st.st_size
+        etag = etag or '"%x-%x"' % (st.st_mtime_ns, size)
+        validators = {"ETag": etag, "Last-Modified": email.utils.formatdate(st.st_mtime, usegmt=True),
+                      "Cache-Control": cache, "Accept-Ranges": "bytes"}
+        if self.not_modified(etag, st.st_mtime):
+            self._set_headers(304,extra=validators); return
+        ctype = ctype or mimetypes.guess_type(fpath)[0] or "application/octet-stream"
+        start, end = 0, size-1; status = 200
+        rng = self.headers.get("Range")
+        if rng and self.headers.get("If-Range", etag) == etag:
+            m = re.fullmatch(r"bytes=(\d*)-(\d*)", rng.strip())
+            if m and (m.group(1) or m.group(2)):
+                if m.group(1): start = int(m.group(1)); end = min(int(m.group(2)), size-1) if m.group(2) else size-1
+                else: start = max(0, size-int(m.group(2)))   # suffix range: last N bytes
+                if start > end or start >= size:
+                    self._set_headers(416,ctype="text/plain",extra={"Content-Range":f"bytes */{size}","Content-Length":"0"}); return
+                status = 206; validators["Content-Range"] = f"bytes {start}-{end}/{size}"
+        validators["Content-Length"] = str(end-start+1)
+        self._set_headers(status,ctype=ctype,extra=validators)
+        with open(fpath,"rb") as f:
+            if end >= start: metrics.inc("http_response_bytes_total", n=self.connection.sendfile(f, start, end-start+1))
+
+    def not_modified(self, etag, mtime):
+        inm = self.headers.get("If-None-Match")
+        if inm is not None: return inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]
+        ims = self.headers.get("If-Modified-Since")
+        if not ims: return False
+        try: return int(mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError): return False
+
+    def page(self): return self.send_asset(assets["/"])
+
+    def send_asset(self, asset):
+        coding = asset.choose(self.headers.get("Accept-Encoding"))
+        body, etag = asset.variants[coding]
+        extra = {"ETag": etag, "Cache-Control": asset.cache, "Vary": "Accept-Encoding"}
+        if etag in [t.strip() for t in self.headers.get("If-None-Match","").split(",")]:
+            self._set_headers(304,ctype=asset.ctype,extra=extra); return
+        if coding != "identity": extra["Content-Encoding"] = coding
+        extra["Content-Length"] = str(len(body))
+        self._set_headers(200,ctype=asset.ctype,extra=extra)
+        self.wfile.write(body); metrics.inc("http_response_bytes_total", n=len(body))
 
     def sse(self):
+        room = self.room()
+        if not room: return
         self._set_headers(200,ctype="text/event-stream",extra={"Cache-Control":"no-cache","Connection":"keep-alive"})
-        last=0; self.wfile.write(b": hi\n\n"); self.wfile.flush()
-        while True:
+        q = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        last = stream_cursor(room, q, self.headers); user = stream_user(q)
+        st = SSEStream(room, self.connection)
+        with room.cond: backlog = room.messages.since(last)
+        self.connection.settimeout(SSE_WRITE_TIMEOUT)   # a stalled client fails its write instead of pinning this thread
+        data = sse_hello() + st.start(room, last, backlog)
+        streams.add(st); heartbeats.add(st); presence.join(room, user)
+        while not st.reaped:
             try:
-                with msg_cond:
-                    if last>=len(messages): msg_cond.wait(timeout=20)
-                    new=list(messages)[last:]
-                for m in new:
-                    self.wfile.write(b"data: "+json.dumps(m).encode()+b"\n\n"); self.wfile.flush(); last+=1
+                if data:
+                    with st.lock: self.wfile.write(data)
+                with room.cond:
+                    if st.waiting(room): room.cond.wait(timeout=HEARTBEAT_INTERVAL)   # wakes to notice a reap
+                    if st.waiting(room): data = b""; continue
+                if SSE_COALESCE_MS: time.sleep(SSE_COALESCE_MS/1000)   # let a burst pile up
+                with room.cond: items = room.messages.since(st.last) + room.signals_since(st.sig)
+                data = st.next(room, items)
+                if data is None: break
+            except TimeoutError: metrics.inc("chat_slow_consumer_total", (("action", "timeout"),)); break
             except: break
+        streams.discard(st); heartbeats.remove(st); presence.leave(room, user); self.close_connection = True
+
+    def websocket(self):
+        # Threaded /ws: this thread reads frames, a second one writes the room's messages.
+        room = self.room()
+        if not room: return
+        hs = ws_handshake(self.headers)
+        if hs is None: self._reply(400, b"Bad WebSocket handshake"); return
+        self.send_response(101); [self.send_header(k,v) for k,v in hs.items()]; self.end_headers()
+        self.close_connection = True
+        ws = WebSocket("Sec-WebSocket-Extensions" in hs); done = threading.Event()
+        q = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        last = stream_cursor(room, q, self.headers); user = stream_user(q)
+        st = SSEStream(room, self.connection, "ws", ws.message); streams.add(st); heartbeats.add(st)
+        with room.cond: backlog = room.messages.since(last)
+        first = st.start(room, last, backlog); presence.join(room, user)
+        # The socket timeout bounds writes. Reads go to the socket itself from here on, as
+        # rfile can't be read again once it times out; first take what it already buffered.
+        self.connection.setblocking(False)
+        try: data = self.rfile.read1(65536) or b""
+        except BlockingIOError: data = b""
+        self.connection.settimeout(SSE_WRITE_TIMEOUT)
+        def send(data):
+            with st.lock: self.connection.sendall(data)
+        def writer(data):
+            try:
+                while not done.is_set() and data is not None:
+                    if data: send(data)
+                    with room.cond:
+                        if st.waiting(room): room.cond.wait(timeout=HEARTBEAT_INTERVAL)   # wakes to notice done
+                        items = room.messages.since(st.last) + room.signals_since(st.sig)
+                    data = st.next(room, items)
+            except TimeoutError: metrics.inc("chat_slow_consumer_total", (("action", "timeout"),))
+            except OSError: pass
+            done.set()
+            try: self.connection.shutdown(socket.SHUT_RDWR)   # wakes the reader
+            except OSError: pass
+        threading.Thread(target=writer, args=(first,), name="ws-out", daemon=True).start()
+        try:
+            while not done.is_set():
+                if not data:
+                    try: data = self.connection.recv(65536)
+                    except TimeoutError: continue
+                    if not data: break
+                frames, data = ws.feed(data), b""
+                for op, payload in frames:
+                    if op == 0x8: send(ws_frame(payload[:2], 0x8)); return   # close: echo the status code
+                    if op == 0x9: send(ws_frame(payload, 0xA))
+                    elif op == 0x1: ws_action(room, payload, self.client_address[0])
+        except (OSError, ValueError): pass
+        finally:
+            done.set(); streams.discard(st); heartbeats.remove(st); presence.leave(room, user)
+
+class _PrefixedReader(io.RawIOBase):
+    # Replays bytes the event loop already read before continuing with the socket.
+    def __init__(self, prefix, raw): self.prefix = memoryview(prefix); self.raw = raw
+    def readable(self): return True
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix)); b[:n] = self.prefix[:n]; self.prefix = self.prefix[n:]; return n
+        return self.raw.readinto1(b)   # readinto() would block until b is full
+    def close(self):
+        # Must release the socket's makefile() reference, or the fd is closed late by GC.
+        self.raw.close(); super().close()
+
+class _PooledChatHandler(ChatHandler):
+    # ChatHandler run on a pool thread for one request read by the async engine:
+    # the whole request, or (streamed) its head with the body still on the socket.
+    def __init__(self, data, streamed, *a): self.data = data; self.streamed = streamed; super().__init__(*a)
+    def setup(self):
+        super().setup()
+        if self.streamed: self.rfile = io.BufferedReader(_PrefixedReader(self.data, self.rfile))
+        else: self.rfile.close(); self.rfile = io.BytesIO(self.data)
+    def handle(self):
+        # One request only; on a keep-alive connection the event loop waits for the next.
+        self.handle_one_request()
+        if self.streamed: self.close_connection = True
+
+class AsyncChatServer:
+    # asyncio engine: every /stream subscriber is a coroutine with its own queue, so
+    # an idle tab costs a socket and a few KB instead of an OS thread. Target is 10k
+    # idle subscribers per process (raise `ulimit -n` accordingly). All other routes
+    # are ordinary ChatHandler requests run on a small thread pool.
+    SSE_HEAD = (b"HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+    BAD_ROOM = b"HTTP/1.0 400 Bad Request\r\nContent-Type: text/plain\r\nContent-Length: 8\r\n\r\nBad room"
+    BAD_WS = b"HTTP/1.0 400 Bad Request\r\nContent-Type: text/plain\r\nContent-Length: 23\r\n\r\nBad WebSocket handshake"
+
+    def __init__(self, host, port, reuse_port=False):
+        self.server_address = (host, port); self.reuse_port = reuse_port; self.subscribers = {}; self.loop = None   # room name -> set of queues
+        self.pool = ThreadPoolExecutor(ASYNC_POOL_SIZE, thread_name_prefix="chat-http")
+
+    def on_message(self, room, e):
+        # Runs on whichever thread published, under room.cond. e is an Entry or a Signal.
+        self.loop.call_soon_threadsafe(self.fanout, room.name, e)
+
+    def fanout(self, name, e):
+        for q in self.subscribers.get(name, ()):
+            if q.full(): q.get_nowait()   # slow subscriber: drop its oldest; shed() sees the gap
+            q.put_nowait(e)
 
-def run():
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        msg_listeners.append(self.on_message); signal_listeners.append(self.on_message)
+        sock = socket.create_server(self.server_address, backlog=ASYNC_BACKLOG, reuse_port=self.reuse_port)
+        sock.setblocking(False)
+        try:
+            while True:
+                conn, addr = await self.loop.sock_accept(sock)
+                self.loop.create_task(self.handle(conn, addr))
+        finally:
+            msg_listeners.remove(self.on_message); signal_listeners.remove(self.on_message)
+            sock.close()
+
+    async def recv_until(self, conn, buf, done):
+        while not done(buf):
+            chunk = await self.loop.sock_recv(conn, 65536)
+            if not chunk: return None
+            buf += chunk
+        return buf
+
+    async def handle(self, conn, addr):
+        # Idle keep-alive connections wait here, not on a pool thread. Small request
+        # bodies are read here too, so the pool thread never waits on the client.
+        buf = b""
+        try:
+            while True:
+                buf = await asyncio.wait_for(self.recv_until(conn, buf, lambda b: b"\r\n\r\n" in b or len(b) > 65536), KEEPALIVE_TIMEOUT)
+                if buf is None or b"\r\n\r\n" not in buf: break
+                end = buf.index(b"\r\n\r\n") + 4; head, buf = buf[:end], buf[end:]
+                line, _, rest = head.partition(b"\r\n")
+                parts = line.decode("latin-1").split(); headers = http.client.parse_headers(io.BytesIO(rest))
+                route = urllib.parse.urlparse(parts[1]).path if len(parts) == 3 and parts[0] == "GET" else None
+                if route == "/stream": return await self.stream(conn, addr, parts[1], headers)
+                if route == "/ws": return await self.websocket(conn, addr, parts[1], headers, buf)
+                try: length = int(headers.get("Content-Length") or 0)
+                except ValueError: length = -1
+                streamed = not 0 <= length <= ASYNC_BODY_BUFFER
+                if not streamed:
+                    buf = await self.recv_until(conn, buf, lambda b: len(b) >= length)
+                    if buf is None: break
+                    head += buf[:length]; buf = buf[length:]
+                else: head += buf; buf = b""
+                conn.setblocking(True)
+                keep = await self.loop.run_in_executor(self.pool, self.run_handler, conn, addr, head, streamed)
+                if not keep: return
+                conn.setblocking(False)
+        except (OSError, asyncio.TimeoutError): pass
+        conn.close()
+
+    def run_handler(self, conn, addr, data, streamed):
+        # True when the connection stays open for another request.
+        try:
+            if not _PooledChatHandler(data, streamed, conn, addr, self).close_connection: return True
+        except Exception: traceback.print_exc()
+        try: conn.shutdown(socket.SHUT_WR)
+        except OSError: pass
+        conn.close()
+        return False
+
+    async def room(self, name):
+        # get_room() on a pool thread: a room new to a bus follower waits for the hub's snapshot.
+        return await self.loop.run_in_executor(self.pool, get_room, name)
+
+    def present(self, room, user):
+        # presence.join on a pool thread, as on a bus follower it writes to the hub. Returns
+        # the matching leave, which runs on the pool once the join has, so it never passes it.
+        joined = self.loop.run_in_executor(self.pool, presence.join, room, user)
+        return lambda: joined.add_done_callback(lambda _: self.pool.submit(presence.leave, room, user))
+
+    def subscribe(self, room, q, last):
+        # Joins room's fan-out; returns what is already past last. Entries published
+        # meanwhile may arrive both ways, so consumers skip seqs they have sent.
+        subs = self.subscribers.setdefault(room.name, set())
+        with room.cond: backlog = room.messages.since(last); subs.add(q)
+        return backlog
+
+    def unsubscribe(self, room, q):
+        subs = self.subscribers.get(room.name)
+        if subs is None: return
+        subs.discard(q)
+        if not subs: del self.subscribers[room.name]
+
+    async def stream(self, conn, addr, path, headers):
+        q = asyncio.Queue(SUBSCRIBER_QUEUE); query = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
+        room = await self.room(query.get("room",[None])[0])
+        metrics.request("GET", "/stream", 400 if room is None else 200, 0)   # not a ChatHandler request
+        if room is None:
+            try: await self.loop.sock_sendall(conn, self.BAD_ROOM)
+            except OSError: pass
+            conn.close(); return
+        last = stream_cursor(room, query, headers); user = stream_user(query)
+        backlog = self.subscribe(room, q, last)
+        st = SSEStream(room, conn); streams.add(st)
+        task = asyncio.current_task(); st.on_reap = lambda: self.loop.call_soon_threadsafe(task.cancel)   # it may be idle in q.get()
+        data = self.SSE_HEAD + sse_hello() + st.start(room, last, backlog)   # signals past st.sig reach q
+        heartbeats.add(st); leave = self.present(room, user)
+        try:
+            while data is not None:
+                if data:
+                    with st.lock: await asyncio.wait_for(self.loop.sock_sendall(conn, data), SSE_WRITE_TIMEOUT)
+                items = [await q.get()]
+                if SSE_COALESCE_MS: await asyncio.sleep(SSE_COALESCE_MS/1000)
+                while not q.empty(): items.append(q.get_nowait())
+                data = st.next(room, items)
+        except asyncio.TimeoutError: metrics.inc("chat_slow_consumer_total", (("action", "timeout"),))
+        except OSError: pass
+        finally:
+            self.unsubscribe(room, q); streams.discard(st); heartbeats.remove(st); leave(); conn.close()
+
+    async def websocket(self, conn, addr, path, headers, buf):
+        # Async /ws: one task reads frames while this coroutine writes the room's messages.
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(path).query); room = await self.room(query.get("room",[None])[0])
+        hs = ws_handshake(headers) if room else None
+        metrics.request("GET", "/ws", 400 if hs is None else 101, 0)
+        if hs is None:
+            try: await self.loop.sock_sendall(conn, self.BAD_ROOM if room is None else self.BAD_WS)
+            except OSError: pass
+            conn.close(); return
+        q = asyncio.Queue(SUBSCRIBER_QUEUE); lock = asyncio.Lock(); ws = WebSocket("Sec-WebSocket-Extensions" in hs)
+        last = stream_cursor(room, query, headers); user = stream_user(query)
+        backlog = self.subscribe(room, q, last)
+        st = SSEStream(room, conn, "ws", ws.message); streams.add(st); heartbeats.add(st)
+        first = st.start(room, last, backlog); leave = self.present(room, user)
+        async def send(data):
+            # lock orders this connection's coroutines; st.lock only keeps heartbeats out
+            async with lock:
+                with st.lock: await asyncio.wait_for(self.loop.sock_sendall(conn, data), SSE_WRITE_TIMEOUT)
+        async def reader(data):
+            try:
+                while True:
+                    for op, payload in ws.feed(data):
+                        if op == 0x8: await send(ws_frame(payload[:2], 0x8)); return   # close: echo the status code
+                        if op == 0x9: await send(ws_frame(payload, 0xA))
+                        elif op == 0x1: await self.loop.run_in_executor(self.pool, ws_action, room, payload, addr[0])
+                    data = await self.loop.sock_recv(conn, 65536)
+                    if not data: return
+            except (OSError, ValueError, asyncio.TimeoutError): pass
+        rt = None
+        try:
+            await send(b"HTTP/1.1 101 Switching Protocols\r\n" + "".join(f"{k}: {v}\r\n" for k, v in hs.items()).encode() + b"\r\n" + first)
+            rt = self.loop.create_task(reader(buf))   # buf: frames that came with the handshake
+            while not rt.done():
+                getter = self.loop.create_task(q.get())
+                done, _ = await asyncio.wait({getter, rt}, return_when=asyncio.FIRST_COMPLETED)   # a reap ends rt
+                if getter not in done: getter.cancel(); break
+                items = [getter.result()]
+                while not q.empty(): items.append(q.get_nowait())
+                data = st.next(room, items)
+                if data is None: break
+                if data: await send(data)
+        except asyncio.TimeoutError: metrics.inc("chat_slow_consumer_total", (("action", "timeout"),))
+        except OSError: pass
+        finally:
+            if rt: rt.cancel()
+            self.unsubscribe(room, q); streams.discard(st); heartbeats.remove(st); leave(); conn.close()
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError): pass
+
+class ChatServer(socketserver.ThreadingTCPServer):
+    # A /stream handler only returns when its client goes away, so handler threads are
+    # daemons: SIGTERM must not wait for every open tab to disconnect. The restart that
+    # follows binds the port again while those connections are still in TIME_WAIT.
+    daemon_threads = True; allow_reuse_address = True
+
+class ReusePortServer(ChatServer):
+    # Threaded engine under --workers: every worker binds the same port and the kernel spreads connections.
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1); super().server_bind()
+
+def serve(engine, port, reuse_port=False):
+    if engine == "async":
+        raise_fd_limit(); asyncio.run(AsyncChatServer(HOST, port, reuse_port).serve_forever())
+    else:
+        with (ReusePortServer if reuse_port else ChatServer)((HOST, port), ChatHandler) as server: server.serve_forever()
+
+def spawn_workers(n, engine, port, journal_dir, bus_spec):
+    args = [sys.executable, os.path.abspath(__file__), "--engine", engine, "--port", str(port), "--no-tunnel",
+            "--sse-coalesce-ms", str(SSE_COALESCE_MS), "--slow-consumer", SLOW_CONSUMER, "--bus", bus_spec, "--worker"]
+    if not RATE_LIMITS: args.append("--no-rate-limit")
+    if access_log: args += ["--access-log", "-" if access_log.name == sys.stdout.fileno() else access_log.name]
+    args += ["--journal", journal_dir] if journal_dir else ["--no-journal"]
+    return [subprocess.Popen(args) for _ in range(n)]
+
+def run(engine=ENGINE, port=PORT, tunnel=True, journal_dir=JOURNAL_DIR, workers=1, bus_spec=None, bus_listen=None, worker=False):
+    global journal_root, bus
+    journal_root = journal_dir
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))   # deploys: unwind so the journal flushes
+    msg_listeners.append(search.on_message); msg_listeners.append(typists.on_message)
+    if bus_spec: bus = NetBus(bus_spec, reconnect=not worker)
+    if worker:
+        # Started by --workers; rooms, seqs and the journal belong to the parent.
+        try: serve(engine, port, reuse_port=True)
+        except KeyboardInterrupt: pass
+        return
     init_default_assets()
-    with msg_cond: messages.append({"user":"NewGen Tech","text":"Welcome to NewGen Tech Group Chat 🚀","ts":now_ms(),"type":"system"})
-    httpd = socketserver.ThreadingTCPServer((HOST, PORT), ChatHandler)
+    main = get_room(DEFAULT_ROOM)
+    if bus.sequencer:
+        if journal_dir: print(f"Replayed {len(main.messages)} messages from {journal_dir}/")
+        if not main.messages.seq:
+            main.publish({"user":"NewGen Tech","text":"Welcome to NewGen Tech Group Chat 🚀","ts":now_ms(),"type":"system"})
+    else: print(f"Following message bus hub at {bus_spec}")
     ip = local_ip()
-    print(f"Local:  http://{ip}:{PORT}/")
-    print("Public (if tunnel works):"); start_tunnel(PORT)
-    try: httpd.serve_forever()
+    print(f"Local:  http://{ip}:{port}/  [{engine} engine" + (f", {workers} workers]" if workers > 1 else "]"))
+    if tunnel: print("Public (if tunnel works):"); start_tunnel(port)
+    hub = BusHub() if workers > 1 or bus_listen else None; procs = []
+    try:
+        if bus_listen: hub.listen(bus_listen); print(f"Message bus hub on {bus_listen}")
+        if workers > 1:
+            path = os.path.join(tempfile.gettempdir(), f"newgen-chat-{os.getpid()}.sock")
+            hub.listen("unix:" + path)
+            procs = spawn_workers(workers, engine, port, journal_dir, "unix:" + path)
+            for p in procs: p.wait()
+        else:
+            serve(engine, port)
     except KeyboardInterrupt: pass
+    finally:
+        for p in procs: p.terminate()
+        if hub: hub.close()
+        with rooms_lock: journals = [r.journal for r in rooms.values() if r.journal]
+        for j in journals: j.close()
 
-if __name__=="__main__": run()
\ No newline at end of file
+if __name__=="__main__":
+    ap = argparse.ArgumentParser(description="NewGen Tech Chat server")
+    ap.add_argument("--engine", choices=["threaded","async"], default=ENGINE)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--no-tunnel", action="store_true", help="don't open the localhost.run tunnel")
+    ap.add_argument("--journal", default=JOURNAL_DIR, help="message journal directory")
+    ap.add_argument("--no-journal", action="store_true", help="keep history in memory only")
+    ap.add_argument("--sse-coalesce-ms", type=int, default=SSE_COALESCE_MS, help="batch /stream writes over this window")
+    ap.add_argument("--slow-consumer", choices=["drop","disconnect"], default=SLOW_CONSUMER,
+                    help=f"subscribers more than {SUBSCRIBER_QUEUE} messages behind: drop the oldest (and resync) or disconnect")
+    ap.add_argument("--no-rate-limit", action="store_true", help="don't limit how often a client may send or upload")
+    ap.add_argument("--workers", type=int, default=1, help="worker processes sharing the port (SO_REUSEPORT)")
+    ap.add_argument("--bus-listen", metavar="HOST:PORT", help="serve this node's rooms to other nodes")
+    ap.add_argument("--bus", metavar="HOST:PORT", help="follow the message bus hub of another node")
+    ap.add_argument("--access-log", nargs="?", const="-", metavar="FILE", help="log every request (to stdout, or FILE)")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)   # set on the processes spawned by --workers
+    a = ap.parse_args(); SSE_COALESCE_MS = a.sse_coalesce_ms; SLOW_CONSUMER = a.slow_consumer
+    if a.no_rate_limit: RATE_LIMITS = {}
+    if a.access_log: access_log = open_access_log(a.access_log)
+    run(engine=a.engine, port=a.port, tunnel=not a.no_tunnel, journal_dir=None if a.no_journal else a.journal,
+        workers=a.workers, bus_spec=a.bus, bus_listen=a.bus_listen, worker=a.worker)
\ No newline at end of file
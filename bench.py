@@ -0,0 +1,267 @@
+import threading, time, argparse, os, sys, socket, subprocess, multiprocessing, http.client, json, re, selectors, tempfile, shutil, platform
+import app
+
+# python bench.py rooms    fan-out cost as the room count grows
+# python bench.py workers  /send throughput as --workers grows
+# python bench.py load     end-to-end delivery latency and upload throughput, as JSON
+
+# Fan-out micro-benchmark for rooms. Every room gets a few subscriber threads that
+# run the same wait loop as ChatHandler.sse(); messages are then published into one
+# room, one at a time, waiting until that room's subscribers have each seen it.
+# With a condition per room the cost per message stays flat as rooms are added;
+# the "single cond" columns share one condition between all rooms, like the old
+# global msg_cond, and every message wakes every subscriber.
+
+def subscriber(room, stop, wakeups, i, ack):
+    # ack is only passed for the measured room; its subscribers report the seq they reached.
+    last = room.messages.seq
+    while not stop.is_set():
+        with room.cond:
+            if last >= room.messages.seq: room.cond.wait(timeout=1)
+            new = room.messages.since(last)
+        wakeups[i] += 1
+        if new:
+            last = new[-1].seq
+            if ack:
+                with ack: ack.seen[i] = last; ack.notify_all()
+
+def fanout(n_rooms, n_subs, n_msgs, shared):
+    cond = threading.Condition(); ack = threading.Condition(); stop = threading.Event()
+    rooms = [app.Room(f"bench{r}") for r in range(n_rooms)]
+    if shared:
+        for room in rooms: room.cond = cond
+    wakeups = [0] * (n_rooms * n_subs); ack.seen = [0] * n_subs
+    threads = [threading.Thread(target=subscriber, args=(room, stop, wakeups, r*n_subs+s, ack if r == 0 else None), daemon=True)
+               for r, room in enumerate(rooms) for s in range(n_subs)]
+    for t in threads: t.start()
+    time.sleep(0.2); base = sum(wakeups); target = rooms[0]
+    t0 = time.perf_counter(); c0 = time.process_time()
+    for _ in range(n_msgs):
+        e = target.publish({"user": "bench", "text": "x", "ts": 0, "type": "text"})
+        with ack:
+            while min(ack.seen) < e.seq: ack.wait()
+    wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+    woken = sum(wakeups) - base
+    stop.set()
+    for room in rooms:
+        with room.cond: room.cond.notify_all()
+    for t in threads: t.join()
+    return wall / n_msgs * 1e6, cpu / n_msgs * 1e6, woken / n_msgs
+
+# Worker scale-out: a real server with --workers N is loaded by several client
+# processes posting /send back to back on keep-alive connections. Every message
+# still goes through the bus hub, so this measures the HTTP work that the
+# workers spread over the cores.
+
+def free_port():
+    s = socket.socket(); s.bind(("127.0.0.1", 0)); port = s.getsockname()[1]; s.close(); return port
+
+def post_loop(port, seconds):
+    c = http.client.HTTPConnection("127.0.0.1", port); n = 0; end = time.time() + seconds
+    while time.time() < end:
+        c.request("POST", "/send?room=bench", "username=bench&text=hello", {"Content-Type": "application/x-www-form-urlencoded"})
+        c.getresponse().read(); n += 1
+    return n
+
+def scale(n_workers, engine, clients, seconds):
+    port = free_port()
+    p = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+                          "--port", str(port), "--no-tunnel", "--no-journal", "--no-rate-limit", "--engine", engine, "--workers", str(n_workers)],
+                         stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try: socket.create_connection(("127.0.0.1", port)).close(); break
+            except OSError: time.sleep(0.1)
+        time.sleep(0.5 + 0.2 * n_workers)   # let every worker bind and join the broker
+        with multiprocessing.Pool(clients) as pool:
+            return sum(pool.starmap(post_loop, [(port, seconds)] * clients)) / seconds
+    finally:
+        p.terminate(); p.wait()
+
+# End-to-end load test. A server started like scale() above (in a scratch
+# directory, so uploads and the journal land there) gets N /stream subscribers,
+# all read by one selector thread here, and M sender processes posting /send and
+# /send-emoji. Every message carries the sender's time.monotonic(), which is the
+# same clock in every process on Linux, so each delivery gives a latency.
+# Then /upload is driven with large files. Results are written as JSON so runs
+# can be compared across commits.
+
+STAMP = re.compile(r"t=(\d+\.\d+)")
+
+def start_server(engine, journal, cwd):
+    port = free_port()
+    args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+            "--port", str(port), "--no-tunnel", "--no-rate-limit", "--engine", engine] + (["--journal", "journal"] if journal else ["--no-journal"])
+    p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try: socket.create_connection(("127.0.0.1", port)).close(); break
+        except OSError: time.sleep(0.1)
+    return p, port
+
+def proc_stats(pid):
+    # (RSS in MB, thread count) from /proc; (None, None) where there is no /proc.
+    try:
+        with open(f"/proc/{pid}/status") as f: status = dict(line.split(":", 1) for line in f)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["Threads"])
+    except (OSError, KeyError, ValueError): return None, None
+
+def percentiles(samples):
+    if not samples: return None
+    samples = sorted(samples); pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {"p50": pick(.5), "p90": pick(.9), "p99": pick(.99), "max": round(samples[-1] * 1000, 3)}
+
+def subscribe(port, n, room):
+    socks = []
+    for _ in range(n):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(f"GET /stream?room={room} HTTP/1.1\r\nHost: bench\r\n\r\n".encode()); socks.append(s)
+    for s in socks: s.recv(4096)   # response head and the ": hi" comment: the subscription is live
+    return socks
+
+def read_streams(socks, latencies, stop):
+    # One thread reads every subscriber; SSE events end with a blank line. Only chat
+    # messages carry an id: presence, typing and resync events are named and have none.
+    sel = selectors.DefaultSelector(); bufs = {}
+    for s in socks: s.setblocking(False); sel.register(s, selectors.EVENT_READ); bufs[s] = b""
+    while not stop.is_set():
+        for key, _ in sel.select(timeout=0.2):
+            s = key.fileobj
+            try: data = s.recv(65536)
+            except BlockingIOError: continue
+            now = time.monotonic(); *events, bufs[s] = (bufs[s] + data).split(b"\n\n")
+            for ev in events:
+                fields = dict(line.split(b": ", 1) for line in ev.split(b"\n") if b": " in line)
+                if b"id" not in fields or b"event" in fields or b"data" not in fields: continue
+                m = STAMP.search(json.loads(fields[b"data"]).get("text", ""))
+                if m: latencies.append(now - float(m.group(1)))
+    sel.close()
+
+def send_loop(port, room, seconds, rate, emoji_every):
+    # One sender process: paced at rate messages/s (0 = back to back); every emoji_every-th is an emoji.
+    c = http.client.HTTPConnection("127.0.0.1", port); n = 0; start = time.monotonic(); end = start + seconds
+    while (now := time.monotonic()) < end:
+        if rate and now < start + n / rate: time.sleep(start + n / rate - now); continue
+        stamp = f"t={time.monotonic():.6f}"; n += 1
+        if emoji_every and n % emoji_every == 0:
+            c.request("POST", f"/send-emoji?room={room}", json.dumps({"username": "bench", "emoji": "🎉 " + stamp}), {"Content-Type": "application/json"})
+        else:
+            c.request("POST", f"/send?room={room}", f"username=bench&text={stamp}", {"Content-Type": "application/x-www-form-urlencoded"})
+        c.getresponse().read()
+    return n
+
+def upload_loop(port, count, size):
+    # count uploads of size bytes each, streamed from a 1 MB block; the first bytes differ
+    # per upload so the content-addressed store can't deduplicate them. Seconds per upload.
+    block = os.urandom(1 << 20); boundary = "benchboundary"; out = []
+    for i in range(count):
+        head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"username\"\r\n\r\nbench\r\n"
+                f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"bench{i}.bin\"\r\n\r\n").encode()
+        tail = f"\r\n--{boundary}--\r\n".encode(); unique = os.urandom(32)
+        def body():
+            yield head; yield unique; left = size - len(unique)
+            while left > 0: yield block[:left]; left -= len(block)
+            yield tail
+        c = http.client.HTTPConnection("127.0.0.1", port); t0 = time.monotonic()
+        c.request("POST", "/upload?room=bench-uploads", body(), {"Content-Type": f"multipart/form-data; boundary={boundary}",
+                                                                 "Content-Length": str(len(head) + size + len(tail))})
+        c.getresponse().read(); c.close(); out.append(time.monotonic() - t0)
+    return out
+
+def load(a):
+    cwd = tempfile.mkdtemp(prefix="chat-bench-"); p, port = start_server(a.engine, not a.no_journal, cwd)
+    peak = {"rss": 0, "threads": 0}; sampling = threading.Event()
+    def sample():
+        while not sampling.wait(0.2):
+            rss, threads = proc_stats(p.pid)
+            if rss: peak["rss"] = max(peak["rss"], rss); peak["threads"] = max(peak["threads"], threads)
+    threading.Thread(target=sample, daemon=True).start()
+    try:
+        socks = subscribe(port, a.subscribers, "bench"); latencies = []; stop = threading.Event()
+        reader = threading.Thread(target=read_streams, args=(socks, latencies, stop)); reader.start()
+        t0 = time.monotonic()
+        with multiprocessing.Pool(a.senders) as pool:
+            sent = sum(pool.starmap(send_loop, [(port, "bench", a.seconds, a.rate, a.emoji_every)] * a.senders))
+        elapsed = time.monotonic() - t0; expected = sent * a.subscribers
+        deadline = time.monotonic() + 5
+        while len(latencies) < expected and time.monotonic() < deadline: time.sleep(0.05)   # let the fan-out drain
+        stop.set(); reader.join(); rss, threads = proc_stats(p.pid)
+        for s in socks: s.close()
+        fanout = {"sent": sent, "sent_per_s": round(sent / elapsed, 1), "delivered": len(latencies),
+                  "delivered_per_s": round(len(latencies) / elapsed, 1), "lost": expected - len(latencies),
+                  "latency_ms": percentiles(latencies), "rss_mb": rss and round(rss, 1), "threads": threads}
+        uploads = None
+        if a.uploads:
+            t0 = time.monotonic()
+            with multiprocessing.Pool(a.upload_clients) as pool:
+                per = [a.uploads // a.upload_clients + (i < a.uploads % a.upload_clients) for i in range(a.upload_clients)]
+                times = sum(pool.starmap(upload_loop, [(port, n, a.upload_mb << 20) for n in per if n]), [])
+            elapsed = time.monotonic() - t0; total = len(times) * (a.upload_mb << 20)
+            uploads = {"count": len(times), "bytes": total, "mb_per_s": round(total / elapsed / (1 << 20), 1),
+                       "latency_ms": percentiles(times)}
+        rss_end, threads_end = proc_stats(p.pid)
+        server = {"rss_mb_peak": round(peak["rss"], 1) or None, "threads_peak": peak["threads"] or None,
+                  "rss_mb_end": rss_end and round(rss_end, 1), "threads_end": threads_end}
+    finally:
+        sampling.set(); p.terminate()
+        try: p.wait(5)
+        except subprocess.TimeoutExpired: p.kill(); p.wait()
+        shutil.rmtree(cwd, ignore_errors=True)
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError: commit = None
+    return {"bench": "load", "commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+            "cpus": os.cpu_count(), "params": {k: v for k, v in vars(a).items() if k not in ("bench", "json")},
+            "fanout": fanout, "uploads": uploads, "server": server}
+
+def main():
+    ap = argparse.ArgumentParser(description="NewGen Tech Chat benchmarks")
+    sub = ap.add_subparsers(dest="bench", required=True)
+    r = sub.add_parser("rooms", help="fan-out cost per message as the room count grows")
+    r.add_argument("--rooms", default="1,10,100,500", help="comma separated room counts")
+    r.add_argument("--subs", type=int, default=2, help="subscribers per room")
+    r.add_argument("--messages", type=int, default=500)
+    cpus = os.cpu_count() or 1
+    w = sub.add_parser("workers", help="/send throughput as the worker count grows")
+    w.add_argument("--workers", default=",".join(str(n) for n in sorted({1, 2, 4, 8, 16, cpus}) if n <= cpus), help="comma separated worker counts")
+    w.add_argument("--engine", choices=["threaded", "async"], default="threaded")
+    w.add_argument("--clients", type=int, default=2 * cpus + 2, help="load generating processes")
+    w.add_argument("--seconds", type=float, default=5)
+    l = sub.add_parser("load", help="delivery latency, message rate and uploads against a real server; JSON results")
+    l.add_argument("--engine", choices=["threaded", "async"], default="threaded")
+    l.add_argument("--subscribers", type=int, default=200, help="/stream connections")
+    l.add_argument("--senders", type=int, default=4, help="sender processes")
+    l.add_argument("--rate", type=float, default=50, help="messages/s per sender (0 = as fast as possible)")
+    l.add_argument("--emoji-every", type=int, default=4, help="every Nth message goes to /send-emoji (0 = none)")
+    l.add_argument("--seconds", type=float, default=10)
+    l.add_argument("--uploads", type=int, default=8, help="files to upload after the fan-out run (0 = skip)")
+    l.add_argument("--upload-mb", type=int, default=50)
+    l.add_argument("--upload-clients", type=int, default=2)
+    l.add_argument("--no-journal", action="store_true", help="run the server without its journal")
+    l.add_argument("--json", metavar="FILE", help="also write the results here")
+    a = ap.parse_args()
+    if a.bench == "load":
+        r = load(a); f = r["fanout"]; u = r["uploads"]; srv = r["server"]
+        print(f"{a.subscribers} subscribers, {a.senders} senders at {a.rate:g} msg/s each, {a.seconds:g}s, {a.engine} engine")
+        print(f"sent {f['sent']} ({f['sent_per_s']}/s), delivered {f['delivered']} ({f['delivered_per_s']}/s), lost {f['lost']}")
+        if f["latency_ms"]: print("latency ms  " + "  ".join(f"{k} {v}" for k, v in f["latency_ms"].items()))
+        if u: print(f"uploads {u['count']} x {a.upload_mb} MB: {u['mb_per_s']} MB/s, ms  " + "  ".join(f"{k} {v}" for k, v in u["latency_ms"].items()))
+        print(f"server rss peak {srv['rss_mb_peak']} MB, threads peak {srv['threads_peak']}")
+        if a.json:
+            with open(a.json, "w") as out: json.dump(r, out, indent=2)
+        return
+    if a.bench == "workers":
+        print(f"{a.clients} client processes, {a.seconds:g}s per run, {a.engine} engine, {cpus} cores")
+        print(f"{'workers':>7} {'req/s':>9} {'speedup':>8}")
+        base = None
+        for n in [int(x) for x in a.workers.split(",")]:
+            rate = scale(n, a.engine, a.clients, a.seconds); base = base or rate
+            print(f"{n:>7} {rate:>9.0f} {rate / base:>7.2f}x")
+        return
+    print(f"{a.messages} messages into one room, {a.subs} subscribers per room")
+    print(f"{'rooms':>6} | {'per-room us/msg':>15} {'cpu us':>8} {'wakeups':>8} | {'single cond us/msg':>18} {'cpu us':>8} {'wakeups':>8}")
+    for n in [int(x) for x in a.rooms.split(",")]:
+        row = fanout(n, a.subs, a.messages, False) + fanout(n, a.subs, a.messages, True)
+        print(f"{n:>6} | {row[0]:>15.1f} {row[1]:>8.1f} {row[2]:>8.1f} | {row[3]:>18.1f} {row[4]:>8.1f} {row[5]:>8.1f}")
+
+if __name__ == "__main__":
+    main()
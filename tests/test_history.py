@@ -0,0 +1,70 @@
+# /history cursors: pages that start in the journal and end in the in-memory window.
+# Run with: python -m unittest discover tests
+import http.client, json, os, sys, tempfile, threading, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+WINDOW, TOTAL = 20, 100   # the ring holds seqs 81..100, the journal all of them
+
+class History(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory(); cls.saved = app.MAX_MESSAGES, app.journal_root
+        app.MAX_MESSAGES = WINDOW; app.journal_root = cls.tmp.name
+        cls.room = app.get_room("history-test")
+        app.journal_root = None; cls.memory = app.get_room("history-memory")   # no journal: the window is all there is
+        for room in (cls.room, cls.memory):
+            for lo in range(1, TOTAL + 1, 30):
+                room.publish_many([{"user": "alice", "text": f"m{n}", "ts": n, "type": "text"} for n in range(lo, min(lo + 30, TOTAL + 1))])
+        cls.room.journal.flush()
+        cls.server = app.ChatServer(("127.0.0.1", 0), app.ChatHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown(); cls.server.server_close(); cls.room.journal.close()
+        with app.rooms_lock: del app.rooms["history-test"], app.rooms["history-memory"]
+        app.MAX_MESSAGES, app.journal_root = cls.saved; cls.tmp.cleanup()
+
+    def get(self, query, room="history-test"):
+        c = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=5)
+        c.request("GET", f"/history?room={room}&{query}"); r = c.getresponse(); body = r.read(); c.close()
+        return r.status, body
+
+    def seqs(self, query, room="history-test"):
+        status, body = self.get(query, room); self.assertEqual(status, 200)
+        return [m["seq"] for m in json.loads(body)]
+
+    def test_window_is_where_expected(self):
+        self.assertEqual(self.room.messages.first(), TOTAL - WINDOW + 1)
+
+    def test_cursors(self):
+        r = lambda lo, hi: list(range(lo, hi + 1))
+        for query, want in (("after=0&limit=10", r(1, 10)), ("after=75&limit=10", r(76, 85)), ("after=80&limit=5", r(81, 85)),
+                            ("after=79&limit=1", [80]), ("after=95&limit=10", r(96, 100)), ("after=100", []),
+                            ("before=85&limit=10", r(75, 84)), ("before=81&limit=5", r(76, 80)), ("before=82&limit=1", [81]),
+                            ("before=82&limit=2", [80, 81]), ("before=5&limit=10", r(1, 4)), ("before=1", []),
+                            ("before=1000&limit=3", r(98, 100)), ("limit=30", r(71, 100)), ("after=-5&limit=2", [1, 2]),
+                            ("limit=0", [100]), ("limit=100000", r(1, 100))):
+            with self.subTest(query=query): self.assertEqual(self.seqs(query), want)
+
+    def test_paging_backwards_and_forwards(self):
+        got, before = [], TOTAL + 1
+        while page := self.seqs(f"before={before}&limit=7"): got = page + got; before = page[0]
+        self.assertEqual(got, list(range(1, TOTAL + 1)))
+        got, after = [], 0
+        while page := self.seqs(f"after={after}&limit=7"): got += page; after = page[-1]
+        self.assertEqual(got, list(range(1, TOTAL + 1)))
+
+    def test_without_a_journal(self):
+        self.assertEqual(self.seqs("before=85&limit=10", "history-memory"), list(range(81, 85)))
+        self.assertEqual(self.seqs("after=0&limit=10", "history-memory"), [])
+        self.assertEqual(self.seqs("after=75&limit=10", "history-memory"), list(range(81, 86)))
+
+    def test_bad_cursor(self):
+        for query in ("before=x", "after=1.5", "limit=ten"):
+            with self.subTest(query=query): self.assertEqual(self.get(query)[0], 400)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+# Journal recovery: a restart cuts off what a crash left half written and keeps
+# appending to the newest segment. Run with: python -m unittest discover tests
+import json, os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+def entries(lo, hi): return [app.make_entry({"seq": n, "user": "alice", "text": f"m{n}", "ts": n, "type": "text"}) for n in range(lo, hi + 1)]
+
+class JournalReopen(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(); self.dir = self.tmp.name
+
+    def tearDown(self): self.tmp.cleanup()
+
+    def write(self, lo, hi):
+        j = app.Journal(self.dir); j.tail(1); j.append(*entries(lo, hi)); j.close()
+
+    def files(self): return sorted(os.listdir(self.dir))
+
+    def crash(self, first):
+        # A torn line, and an index record for it, as a crash mid-batch leaves them.
+        log, idx = (os.path.join(self.dir, f"{first:020d}.{ext}") for ext in ("log", "idx"))
+        end = os.path.getsize(log)
+        with open(log, "ab") as f: f.write(b'{"seq": 6, "user": "ali')
+        with open(idx, "ab") as f: f.write(app.Journal.REC.pack(6, end) + b"\x07\x00")   # and half of the next one
+
+    def test_torn_tail_is_cut_and_segment_continued(self):
+        self.write(1, 5); self.crash(1)
+        j = app.Journal(self.dir)
+        self.assertEqual([m["seq"] for m in j.tail(100)], [1, 2, 3, 4, 5])   # replay stops at the last whole record
+        j.append(*entries(6, 8)); j.close()
+        self.assertEqual(self.files(), [f"{1:020d}.idx", f"{1:020d}.log"])   # no new segment
+        with open(os.path.join(self.dir, f"{1:020d}.log"), "rb") as f: lines = f.read().split(b"\n")
+        self.assertEqual(lines[-1], b"")
+        self.assertEqual([json.loads(l)["seq"] for l in lines[:-1]], list(range(1, 9)))
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, f"{1:020d}.idx")), 8 * app.Journal.REC.size)
+        j = app.Journal(self.dir)
+        self.assertEqual([m["seq"] for m in j.tail(100)], list(range(1, 9)))
+        self.assertEqual([json.loads(l)["seq"] for l in j.read(1, 8)], list(range(1, 9)))
+        self.assertEqual([m["seq"] for m in j.replay()], list(range(1, 9)))
+        j.close()
+
+    def test_gap_starts_a_new_segment(self):
+        # Seqs that don't follow the newest segment (e.g. a bus hub's numbering) leave it alone.
+        self.write(1, 5); self.crash(1)
+        with open(os.path.join(self.dir, f"{1:020d}.log"), "rb") as f: before = f.read()
+        j = app.Journal(self.dir); j.tail(100); j.append(*entries(20, 21)); j.close()
+        self.assertEqual(self.files(), [f"{1:020d}.idx", f"{1:020d}.log", f"{20:020d}.idx", f"{20:020d}.log"])
+        with open(os.path.join(self.dir, f"{1:020d}.log"), "rb") as f: self.assertEqual(f.read(), before)
+        j = app.Journal(self.dir)
+        self.assertEqual([m["seq"] for m in j.tail(100)][-2:], [20, 21])
+        j.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# MultipartParser round trips: file bytes must come back exactly, whatever they end in.
+# Run with: python -m unittest discover tests
+import io, os, sys, hashlib, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+BOUNDARY = b"----chatboundary7MA4YWxk"
+
+def body(parts):
+    # parts: (name, filename or None, data)
+    out = b""
+    for name, filename, data in parts:
+        disp = b'form-data; name="%s"' % name.encode()
+        if filename is not None: disp += b'; filename="%s"' % filename.encode()
+        out += b"--" + BOUNDARY + b"\r\nContent-Disposition: " + disp + b"\r\n"
+        if filename is not None: out += b"Content-Type: application/octet-stream\r\n"
+        out += b"\r\n" + data + b"\r\n"
+    return out + b"--" + BOUNDARY + b"--\r\n"
+
+class MultipartRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd(); self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name); os.makedirs(app.UPLOAD_DIR)
+        self.chunk = app.UPLOAD_CHUNK
+
+    def tearDown(self):
+        app.UPLOAD_CHUNK = self.chunk; os.chdir(self.cwd); self.tmp.cleanup()
+
+    def parse(self, parts, chunk):
+        app.UPLOAD_CHUNK = chunk   # small reads put the delimiter across chunk edges
+        data = body(parts)
+        return app.MultipartParser(io.BytesIO(data), BOUNDARY, len(data)).parse()
+
+    def test_file_bytes_survive(self):
+        # The old parser stripped trailing "\r", "\n" and "-" from every file.
+        payloads = [b"", b"-", b"\r", b"\n", b"\r\n", b"--", b"data\r\n--", b"ends with dash-",
+                    b"\r\n--" + BOUNDARY[:-1], bytes(range(256)) * 40 + b"\r\n-"]
+        for chunk in (1, 7, 64, 65536):
+            for payload in payloads:
+                with self.subTest(chunk=chunk, payload=payload[-12:]):
+                    fields, files = self.parse([("username", None, b"alice"), ("file", "a.bin", payload)], chunk)
+                    self.assertEqual(fields, {"username": "alice"})
+                    (name, tmp, digest, size), = files
+                    with open(tmp, "rb") as f: self.assertEqual(f.read(), payload)
+                    self.assertEqual((name, digest, size), ("a.bin", hashlib.sha256(payload).hexdigest(), len(payload)))
+                    os.remove(tmp)
+
+    def test_empty_file_input_is_skipped(self):
+        fields, files = self.parse([("username", None, b"bob"), ("file", "", b""), ("room", None, b"team")], 7)
+        self.assertEqual(fields, {"username": "bob", "room": "team"})
+        self.assertEqual(files, [])
+
+    def test_truncated_body_removes_temp_files(self):
+        data = body([("file", "a.bin", b"x" * 1000)])[:-40]
+        with self.assertRaises(ValueError):
+            app.MultipartParser(io.BytesIO(data), BOUNDARY, len(data)).parse()
+        self.assertEqual([f for f in os.listdir(app.UPLOAD_DIR) if f.startswith(".upload-")], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+# serve_file: Range requests, 416 and conditional GETs, against a running threaded server.
+# Run with: python -m unittest discover tests
+import email.utils, http.client, os, sys, tempfile, threading, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+DATA = bytes(range(256)) * 4 + b"tail"   # 1028 bytes
+
+class ServeFile(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd(); cls.tmp = tempfile.TemporaryDirectory(); os.chdir(cls.tmp.name)
+        os.makedirs(app.STICKER_DIR)
+        with open(os.path.join(app.STICKER_DIR, "s.bin"), "wb") as f: f.write(DATA)
+        open(os.path.join(app.STICKER_DIR, "empty.bin"), "wb").close()
+        cls.mtime = os.stat(os.path.join(app.STICKER_DIR, "s.bin")).st_mtime
+        cls.server = app.ChatServer(("127.0.0.1", 0), app.ChatHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown(); cls.server.server_close(); os.chdir(cls.cwd); cls.tmp.cleanup()
+
+    def get(self, headers=None, name="s.bin"):
+        c = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=5)
+        c.request("GET", f"/{app.STICKER_DIR}/{name}", headers=headers or {})
+        r = c.getresponse(); body = r.read(); c.close()
+        return r.status, r.headers, body
+
+    def test_full(self):
+        status, h, body = self.get()
+        self.assertEqual((status, body, h["Content-Length"], h["Accept-Ranges"]), (200, DATA, str(len(DATA)), "bytes"))
+        self.assertIsNone(h["Content-Range"])
+        self.assertEqual(self.get(name="empty.bin")[::2], (200, b""))
+
+    def test_ranges(self):
+        n = len(DATA)
+        for rng, (lo, hi) in (("bytes=10-19", (10, 19)), ("bytes=1000-", (1000, n-1)), ("bytes=-5", (n-5, n-1)),
+                              ("bytes=-5000", (0, n-1)), ("bytes=1020-9999", (1020, n-1)), ("bytes=0-0", (0, 0)),
+                              (" bytes=3-4 ", (3, 4))):
+            with self.subTest(range=rng):
+                status, h, body = self.get({"Range": rng})
+                self.assertEqual((status, body, h["Content-Range"]), (206, DATA[lo:hi+1], f"bytes {lo}-{hi}/{n}"))
+                self.assertEqual(h["Content-Length"], str(hi - lo + 1))
+
+    def test_unsatisfiable(self):
+        for rng in (f"bytes={len(DATA)}-", "bytes=20-10", f"bytes={len(DATA)}-{len(DATA)+10}"):
+            with self.subTest(range=rng):
+                status, h, body = self.get({"Range": rng})
+                self.assertEqual((status, body, h["Content-Range"]), (416, b"", f"bytes */{len(DATA)}"))
+        self.assertEqual(self.get({"Range": "bytes=0-"}, "empty.bin")[0], 416)
+
+    def test_ranges_it_ignores(self):
+        # Multiple ranges, other units and junk get the whole file.
+        for rng in ("bytes=0-1,5-6", "items=0-1", "bytes=-", "bytes=a-b"):
+            with self.subTest(range=rng):
+                self.assertEqual(self.get({"Range": rng})[::2], (200, DATA))
+
+    def test_if_range(self):
+        etag = self.get()[1]["ETag"]
+        self.assertEqual(self.get({"Range": "bytes=0-3", "If-Range": etag})[::2], (206, DATA[:4]))
+        self.assertEqual(self.get({"Range": "bytes=0-3", "If-Range": '"stale"'})[::2], (200, DATA))
+
+    def test_not_modified(self):
+        etag = self.get()[1]["ETag"]; since = email.utils.formatdate(self.mtime + 1, usegmt=True)
+        for headers in ({"If-None-Match": etag}, {"If-None-Match": '"other", ' + etag}, {"If-None-Match": "*"},
+                        {"If-Modified-Since": since}, {"If-None-Match": etag, "Range": "bytes=0-3"}):
+            with self.subTest(headers=headers):
+                status, h, body = self.get(headers)
+                self.assertEqual((status, body, h["ETag"]), (304, b"", etag))
+        earlier = email.utils.formatdate(self.mtime - 3600, usegmt=True)
+        for headers in ({"If-None-Match": '"other"'}, {"If-Modified-Since": earlier}, {"If-Modified-Since": "garbage"},
+                        {"If-None-Match": '"other"', "If-Modified-Since": since}):   # If-None-Match wins
+            with self.subTest(headers=headers):
+                self.assertEqual(self.get(headers)[::2], (200, DATA))
+
+    def test_outside_the_directory(self):
+        for name in ("%2e%2e/%2e%2e/etc/passwd", "missing.bin", ""):
+            with self.subTest(name=name): self.assertEqual(self.get(name=name)[0], 404)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# WebSocket codec (RFC 6455): handshake, inbound frames as browsers send them, outbound frames.
+# Run with: python -m unittest discover tests
+import os, struct, sys, unittest, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+MASK = b"\x37\xfa\x21\x3d"
+
+def frame(payload, opcode=0x1, fin=True, rsv1=False, mask=MASK, length=None):
+    # A client frame; length forces the 16-bit ("16") or 64-bit ("64") length encoding.
+    b0 = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode; n = len(payload); m = 0x80 if mask else 0
+    if length == "64" or n >= 65536: head = struct.pack("!BBQ", b0, m | 127, n)
+    elif length == "16" or n >= 126: head = struct.pack("!BBH", b0, m | 126, n)
+    else: head = struct.pack("!BB", b0, m | n)
+    if not mask: return head + payload
+    return head + mask + bytes(c ^ mask[i % 4] for i, c in enumerate(payload))
+
+def deflate(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, -15); out = c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+    assert out.endswith(b"\x00\x00\xff\xff"); return out[:-4]
+
+def unframe(f):
+    # (fin, rsv1, opcode, payload) of a server frame, which is never masked.
+    b0, b1 = f[0], f[1]; n = b1 & 0x7f; i = 2
+    if n == 126: n = struct.unpack_from("!H", f, 2)[0]; i = 4
+    elif n == 127: n = struct.unpack_from("!Q", f, 2)[0]; i = 10
+    assert not b1 & 0x80 and len(f) == i + n
+    return bool(b0 & 0x80), bool(b0 & 0x40), b0 & 0x0f, f[i:]
+
+class Handshake(unittest.TestCase):
+    HEADERS = {"Upgrade": "websocket", "Sec-WebSocket-Version": "13", "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ=="}
+
+    def test_accept_key_from_rfc(self):
+        # RFC 6455 section 1.3
+        self.assertEqual(app.ws_handshake(self.HEADERS)["Sec-WebSocket-Accept"], "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=")
+
+    def test_bad_upgrades(self):
+        for drop in ("Upgrade", "Sec-WebSocket-Version", "Sec-WebSocket-Key"):
+            with self.subTest(missing=drop):
+                self.assertIsNone(app.ws_handshake({k: v for k, v in self.HEADERS.items() if k != drop}))
+        self.assertIsNone(app.ws_handshake(dict(self.HEADERS, **{"Sec-WebSocket-Version": "8"})))
+
+    def test_deflate_only_when_offered(self):
+        self.assertNotIn("Sec-WebSocket-Extensions", app.ws_handshake(self.HEADERS))
+        hs = app.ws_handshake(dict(self.HEADERS, **{"Sec-WebSocket-Extensions": "permessage-deflate; client_max_window_bits"}))
+        self.assertEqual(hs["Sec-WebSocket-Extensions"], "permessage-deflate; server_no_context_takeover; client_no_context_takeover")
+        hs = app.ws_handshake(dict(self.HEADERS, **{"Sec-WebSocket-Extensions": "permessage-deflate; server_max_window_bits=10"}))
+        self.assertNotIn("Sec-WebSocket-Extensions", hs)
+
+class Inbound(unittest.TestCase):
+    def test_masked_frame_from_rfc(self):
+        # RFC 6455 section 5.7: a single-frame masked text message
+        self.assertEqual(app.WebSocket(False).feed(bytes.fromhex("818537fa213d7f9f4d5158")), [(0x1, b"Hello")])
+
+    def test_unmasked_frame_is_refused(self):
+        with self.assertRaises(ValueError): app.WebSocket(False).feed(frame(b"Hello", mask=None))
+
+    def test_lengths(self):
+        for n, length in ((0, None), (125, None), (126, None), (300, None), (65535, None), (10, "16"), (1000, "64"),
+                          (app.WS_MAX_MESSAGE, "64")):
+            with self.subTest(n=n, length=length):
+                data = bytes(range(256)) * (n // 256) + bytes(n % 256)
+                self.assertEqual(app.WebSocket(False).feed(frame(data, length=length)), [(0x1, data)])
+
+    def test_oversized_frame_is_refused_from_its_header(self):
+        head = frame(b"", length="64")[:2] + struct.pack("!Q", app.WS_MAX_MESSAGE + 1)
+        with self.assertRaises(ValueError): app.WebSocket(False).feed(head)
+
+    def test_byte_at_a_time(self):
+        ws = app.WebSocket(False); data = frame(b"x" * 300) + frame(b"ping", 0x9) + frame(b"bye")
+        out = [m for i in range(len(data)) for m in ws.feed(data[i:i+1])]
+        self.assertEqual(out, [(0x1, b"x" * 300), (0x9, b"ping"), (0x1, b"bye")])
+
+    def test_fragments_with_control_frames_between(self):
+        ws = app.WebSocket(False)
+        out = ws.feed(frame(b"Hel", fin=False) + frame(b"are you there", 0x9) + frame(b"lo, ", 0x0, fin=False))
+        self.assertEqual(out, [(0x9, b"are you there")])   # controls arrive at once, the message waits for FIN
+        self.assertEqual(ws.feed(frame(b"", 0xA) + frame(b"world", 0x0)), [(0xA, b""), (0x1, b"Hello, world")])
+        self.assertEqual(ws.feed(frame(b"\x03\xe8", 0x8)), [(0x8, b"\x03\xe8")])
+
+    def test_continuation_without_a_message(self):
+        with self.assertRaises(ValueError): app.WebSocket(False).feed(frame(b"x", 0x0))
+
+    def test_oversized_fragmented_message(self):
+        ws = app.WebSocket(False); half = b"x" * (app.WS_MAX_MESSAGE // 2 + 1)
+        with self.assertRaises(ValueError): ws.feed(frame(half, fin=False) + frame(half, 0x0))
+
+    def test_permessage_deflate(self):
+        text = b'{"op": "send", "username": "alice", "text": "' + b"compress me " * 50 + b'"}'
+        z = deflate(text)
+        self.assertEqual(app.WebSocket(True).feed(frame(z, rsv1=True)), [(0x1, text)])
+        # Fragmented: RSV1 is set on the first frame only, and the tail is stripped once, from the last.
+        ws = app.WebSocket(True); cut = len(z) // 2
+        self.assertEqual(ws.feed(frame(z[:cut], rsv1=True, fin=False) + frame(b"", 0x9) + frame(z[cut:], 0x0)),
+                         [(0x9, b""), (0x1, text)])
+        self.assertEqual(ws.feed(frame(b"plain")), [(0x1, b"plain")])   # uncompressed messages still allowed
+
+    def test_compressed_frame_without_deflate(self):
+        with self.assertRaises(ValueError): app.WebSocket(False).feed(frame(deflate(b"hi"), rsv1=True))
+
+class Outbound(unittest.TestCase):
+    def test_frame_lengths(self):
+        for n, head in ((0, 2), (125, 2), (126, 4), (65535, 4), (65536, 10)):
+            with self.subTest(n=n):
+                f = app.ws_frame(b"a" * n); self.assertEqual(len(f), head + n)
+                self.assertEqual(unframe(f), (True, False, 0x1, b"a" * n))
+        self.assertEqual(unframe(app.ws_frame(b"\x03\xe8", 0x8)), (True, False, 0x8, b"\x03\xe8"))
+
+    def test_message_is_built_once_per_entry(self):
+        e = app.make_entry({"seq": 7, "user": "alice", "text": "hi " * 100, "ts": 1, "type": "text"})
+        plain, z = app.WebSocket(False).message(e), app.WebSocket(True).message(e)
+        self.assertIs(app.WebSocket(False).message(e), plain); self.assertIs(app.WebSocket(True).message(e), z)
+        self.assertEqual(unframe(plain), (True, False, 0x1, e.json))
+        fin, rsv1, opcode, payload = unframe(z)
+        self.assertEqual((fin, rsv1, opcode), (True, True, 0x1))
+        self.assertEqual(zlib.decompressobj(-15).decompress(payload + b"\x00\x00\xff\xff"), e.json)
+
+if __name__ == "__main__":
+    unittest.main()